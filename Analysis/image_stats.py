@@ -1,70 +1,313 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from scipy.stats import mode
-from skimage import measure
-from skimage.measure import label, regionprops
-from skimage.morphology import closing, square
+from scipy import ndimage
 from sklearn import metrics
 from tensorflow.python.keras.models import load_model
 from Analysis.model_stats import confusion_matrix, ROC_one_vs_all, PR_one_vs_all
+from Analysis.region_stats import mask_stats_batch
 
 
 def calculate_stats(img, image_res, substrate_num=0, liquid_num=1, nano_num=2):
-    # Region Properties
-    region = (measure.regionprops((img != 0) + 1)[0])
-
-    # Broadly estimate category
-    if int(mode(img, axis=None).mode) == liquid_num:
-        if np.sum(img == substrate_num) / image_res ** 2 >= 0.02:
-            # Hole if dominant category is water and also has an amount of substrate
-            cat = "hole"
-        else:
-            # Liquid if dominant category is water (==1)
-            cat = "liquid"
-    elif -0.00025 <= region["euler_number"] / np.sum(img == nano_num):
-        # Cell/Worm if starting to form
-        cat = "cellular"
-    elif -0.01 <= region["euler_number"] / np.sum(img == nano_num) < -0.001:
-        # Labyrinth
-        cat = "labyrinth"
-    elif region["euler_number"] / np.sum(img == nano_num) <= -0.03:
-        # Island
-        cat = "island"
-    else:
-        cat = "none"
-
-    return region, cat
+    """
+    Region statistics and broad category of a single image. See calculate_stats_batch
+
+    Returns
+    -------
+    region : dict
+        Euler number, perimeter, eccentricity and area of regionprops((img != 0) + 1)[0]
+    cat : str
+        Category of img
+    """
+    regions, cats = calculate_stats_batch(img[np.newaxis], image_res, substrate_num, liquid_num, nano_num)
+
+    return {key: value[0] for key, value in regions.items()}, str(cats[0])
+
+
+def calculate_stats_batch(imgs, image_res, substrate_num=0, liquid_num=1, nano_num=2):
+    """
+    Region statistics and broad category of every image of a stack, in parallel
+
+    The region is regionprops((img != 0) + 1)[0], i.e. the substrate if the image has any, otherwise everything
+    else, and its statistics come from the numba kernels of Analysis.region_stats
+
+    Parameters
+    ----------
+    imgs : ndarray
+        (N x H x W) stack of images
+    image_res : int or ndarray
+        Size of the simulations (L), either shared or one per image
+    substrate_num, liquid_num, nano_num : int, optional
+        Levels of the substrate, liquid and nanoparticles. Default 0, 1 and 2
+
+    Returns
+    -------
+    regions : dict
+        Euler number, perimeter, eccentricity and area of each image's region
+    cats : ndarray
+        Category of each image, one of "liquid", "hole", "cellular", "labyrinth", "island" or "none"
+    """
+    imgs = np.asarray(imgs)
+    masks = np.where(np.any(imgs == 0, axis=(1, 2))[:, np.newaxis, np.newaxis], imgs == 0, imgs != 0)
+    stats = mask_stats_batch(masks)
+    eccentricity, _ = shape_stats_from_moments(*stats["moments"])
+    regions = {"euler_number": stats["euler_number"], "perimeter": stats["perimeter"],
+               "eccentricity": eccentricity, "area": stats["moments"][0]}
+
+    # Broadly estimate category. Ties in the mode go to the smallest level, as with scipy.stats.mode
+    levels = np.unique(imgs)
+    level_counts = np.stack([np.sum(imgs == level, axis=(1, 2)) for level in levels])
+    modes = levels[np.argmax(level_counts, axis=0)]
+    cats = categorise_windows(stats["euler_number"], modes, np.sum(imgs == substrate_num, axis=(1, 2)),
+                              np.sum(imgs == nano_num, axis=(1, 2)), image_res, liquid_num)
+
+    return regions, cats
+
+
+def categorise_windows(euler_nums, modes, substrate_counts, nano_counts, image_res, liquid_num=1):
+    """The categories of calculate_stats, from each window's Euler number, mode and substrate/nanoparticle counts"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalised_euler = euler_nums / nano_counts
+
+    return np.select([(modes == liquid_num) & (substrate_counts / image_res ** 2 >= 0.02),
+                      modes == liquid_num,
+                      -0.00025 <= normalised_euler,
+                      (-0.01 <= normalised_euler) & (normalised_euler < -0.001),
+                      normalised_euler <= -0.03],
+                     ["hole", "liquid", "cellular", "labyrinth", "island"], default="none")
+
+
+def window_euler_numbers(img, window_size, stride, last_region=False):
+    """
+    Euler number of regionprops((window != 0) + 1)[0] (or [-1] if last_region) for every window of img, in the order
+    of window_corners. The first region is the zero pixels if the window has any, otherwise the nonzero pixels, and
+    the last region the nonzero pixels if the window has any, otherwise the zero pixels
+    """
+    rows, cols = window_corners(img.shape, window_size, stride)
+    zero_engine = SlidingWindowEuler(img == 0)
+    nonzero_engine = SlidingWindowEuler(img != 0)
+
+    use_zeros = use_zero_region(zero_engine.counts(rows, cols, window_size), window_size ** 2, last_region)
+
+    return np.where(use_zeros, zero_engine.euler_numbers(rows, cols, window_size),
+                    nonzero_engine.euler_numbers(rows, cols, window_size))
+
+
+def region_euler_numbers_batch(windows, last_region=False):
+    """As window_euler_numbers, for an (N x H x W) stack of already cut windows"""
+    windows = np.asarray(windows)
+    use_zeros = use_zero_region(np.sum(windows == 0, axis=(-2, -1)), windows.shape[-2] * windows.shape[-1],
+                                last_region)
+
+    return np.where(use_zeros, euler_numbers_batch(windows == 0), euler_numbers_batch(windows != 0))
+
+
+def window_corners(img_shape, window_size, stride):
+    """Top-left corner (rows, cols) of each window, in the order windows are cut by ImageClassifier"""
+    num_jumps = int((img_shape[0] - window_size) / stride)
+    rows, cols = np.meshgrid(np.arange(num_jumps) * stride, np.arange(num_jumps) * stride, indexing="ij")
+
+    return rows.ravel(), cols.ravel()
+
+
+class SlidingWindowEuler:
+    """
+    Euler number (8-connected, as skimage.measure.regionprops) and pixel count of a binary mask, for any square
+    window, in O(1) per window
+
+    The Euler number of a mask is a sum of contributions of its 2x2 pixel quads, (Q1 - Q3 - 2 * QD) / 4, where Q1 and
+    Q3 are quads with one and three pixels set, and QD quads with only a diagonal pair set. Quad contributions inside
+    the whole mask are summed into an integral image once. A window is taken as zero-padded, so its quads over the
+    padding depend only on its edge pixels and corners, which are found from cumulative sums along rows and columns
+
+    Parameters
+    ----------
+    mask : ndarray
+        2D boolean mask
+    """
+
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        self._mask = mask
+        self._quad_integral = _integral_image(_quad_euler_contributions(mask))
+        self._count_integral = _integral_image(mask)
+
+        # Edge quads of a zero-padded window only count (as Q1) if exactly one of their two pixels is set
+        row_changes = mask[:, :-1] != mask[:, 1:]
+        col_changes = mask[:-1, :] != mask[1:, :]
+        self._row_change_cumsum = np.pad(np.cumsum(row_changes, axis=1), ((0, 0), (1, 0)))
+        self._col_change_cumsum = np.pad(np.cumsum(col_changes, axis=0), ((1, 0), (0, 0)))
+
+    def euler_numbers(self, rows, cols, window_size):
+        """Euler number of the windows with top-left corners (rows, cols)"""
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        last_rows, last_cols = rows + window_size - 1, cols + window_size - 1
+
+        interior = _box_sum(self._quad_integral, rows, cols, last_rows, last_cols)
+        edges = self._row_change_cumsum[rows, last_cols] - self._row_change_cumsum[rows, cols] + \
+                self._row_change_cumsum[last_rows, last_cols] - self._row_change_cumsum[last_rows, cols] + \
+                self._col_change_cumsum[last_rows, cols] - self._col_change_cumsum[rows, cols] + \
+                self._col_change_cumsum[last_rows, last_cols] - self._col_change_cumsum[rows, last_cols]
+        corners = self._mask[rows, cols].astype(int) + self._mask[rows, last_cols] + \
+                  self._mask[last_rows, cols] + self._mask[last_rows, last_cols]
+
+        return (interior + edges + corners) // 4
+
+    def counts(self, rows, cols, window_size):
+        """Number of set pixels in the windows with top-left corners (rows, cols)"""
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        return _box_sum(self._count_integral, rows, cols, rows + window_size, cols + window_size)
+
+
+def euler_numbers_batch(masks):
+    """Euler number (8-connected, as skimage.measure.regionprops) of each (zero-padded) mask in a (N x H x W) stack"""
+    padded = np.pad(np.asarray(masks, dtype=bool), ((0, 0), (1, 1), (1, 1)))
+    return np.sum(_quad_euler_contributions(padded), axis=(-2, -1)) // 4
+
+
+class SlidingWindowMoments:
+    """
+    Raw moments (up to second order) of a binary mask for any square window, in O(1) per window, from integral
+    images of the mask weighted by each power of the pixel coordinates
+
+    Parameters
+    ----------
+    mask : ndarray
+        2D boolean mask
+    """
+
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        rows, cols = np.indices(mask.shape)
+        self._integrals = [_integral_image(mask * weight) for weight in
+                           (1, rows, cols, rows ** 2, cols ** 2, rows * cols)]
+
+    def moments(self, rows, cols, window_size):
+        """(m00, m10, m01, m20, m02, m11) of the windows with top-left corners (rows, cols)"""
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        return tuple(_box_sum(integral, rows, cols, rows + window_size, cols + window_size)
+                     for integral in self._integrals)
+
+
+def moments_batch(masks):
+    """(m00, m10, m01, m20, m02, m11) of each mask in a (N x H x W) stack"""
+    masks = np.asarray(masks, dtype=bool)
+    rows, cols = np.indices(masks.shape[-2:])
+    return tuple(np.sum(masks * weight, axis=(-2, -1), dtype=np.int64) for weight in
+                 (1, rows, cols, rows ** 2, cols ** 2, rows * cols))
+
+
+def shape_stats_from_moments(m00, m10, m01, m20, m02, m11):
+    """
+    Eccentricity and equivalent diameter (as skimage.measure.regionprops) of regions with the given raw moments
+
+    Returns
+    -------
+    eccentricity, equivalent_diameter : ndarray
+    """
+    # Central moments (x m00 ** 2), in integers so nothing cancels
+    m00, m10, m01 = np.asarray(m00, dtype=np.int64), np.asarray(m10, dtype=np.int64), np.asarray(m01, dtype=np.int64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mu20 = (m20 * m00 - m10 ** 2) / m00 ** 2
+        mu02 = (m02 * m00 - m01 ** 2) / m00 ** 2
+        mu11 = (m11 * m00 - m10 * m01) / m00 ** 2
+
+        # Eigenvalues of the inertia tensor
+        half_trace = (mu20 + mu02) / 2
+        root = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+        l1 = np.clip(half_trace + root, 0, None)
+        l2 = np.clip(half_trace - root, 0, None)
+        eccentricity = np.where(l1 == 0, 0, np.sqrt(1 - l2 / l1))
+
+    return eccentricity, np.sqrt(4 * m00 / np.pi)
+
+
+def use_zero_region(zero_counts, window_area, last_region=False):
+    """
+    If regionprops((window != 0) + 1)[0] (or [-1] if last_region) of each window is its zero pixels, rather than
+    its nonzero pixels
+    """
+    return zero_counts == window_area if last_region else zero_counts > 0
+
+
+def _quad_euler_contributions(mask):
+    """4 x the Euler number contribution of every 2x2 quad of a mask (or of a stack of masks)"""
+    top_left, top_right = mask[..., :-1, :-1], mask[..., :-1, 1:]
+    bottom_left, bottom_right = mask[..., 1:, :-1], mask[..., 1:, 1:]
+
+    num_set = top_left.astype(np.int8) + top_right + bottom_left + bottom_right
+    is_diagonal = (num_set == 2) & (top_left == bottom_right)
+
+    return (num_set == 1).astype(np.int64) - (num_set == 3) - 2 * is_diagonal
+
+
+def _integral_image(arr):
+    """Zero-padded 2D cumulative sum, so the sum of arr[r0:r1, c0:c1] needs only 4 lookups"""
+    return np.pad(np.cumsum(np.cumsum(arr, axis=0, dtype=np.int64), axis=1), ((1, 0), (1, 0)))
+
+
+def _box_sum(integral, row_starts, col_starts, row_stops, col_stops):
+    return integral[row_stops, col_stops] - integral[row_starts, col_stops] - integral[row_stops, col_starts] + \
+           integral[row_starts, col_starts]
 
 
 def calculate_normalised_stats(img):
-    assert len(np.unique(img)) == 2, "Input image must be binary"
+    SIA, SIP, SIE = calculate_normalised_stats_batch(img[np.newaxis], n_jobs=1)
+
+    return SIA[0], SIP[0], SIE[0]
+
+
+def calculate_normalised_stats_batch(imgs, n_jobs=None):
+    """
+    Size invariant Minkowski stats of a whole (N x H x W) stack of binary images at once
+
+    The stack is closed by scipy.ndimage split across threads, with a structuring element that only connects pixels
+    within an image. Components and perimeters then come from the (parallel) numba kernels of Analysis.region_stats
+
+    Parameters
+    ----------
+    imgs : ndarray
+        (N x H x W) stack of binary images
+    n_jobs : int or None, optional
+        Number of threads for the closing. Default None (one per core)
+
+    Returns
+    -------
+    SIA, SIP, SIE : ndarray
+        Size invariant area, perimeter and Euler characteristic of each image
+    """
+    imgs = np.asarray(imgs)
+    assert len(np.unique(imgs)) == 2 and np.all(imgs.min(axis=(1, 2)) != imgs.max(axis=(1, 2))), \
+        "Input images must be binary"
 
     # Find unique sections
-    img_close = closing(img, square(3))
+    n_jobs = min(n_jobs or os.cpu_count(), len(imgs))
+    chunks = np.array_split(np.arange(len(imgs)), n_jobs)
+    with ThreadPoolExecutor(n_jobs) as executor:
+        img_close = np.concatenate(list(executor.map(
+            lambda chunk: ndimage.grey_closing(imgs[chunk], footprint=np.ones((1, 3, 3))), chunks)))
     img_close_inv = np.abs(1 - img_close)
-    label_img = label(img_close)
-    label_img_inv = label(img_close_inv)
+    close_stats = mask_stats_batch(img_close != 0)
+    close_inv_stats = mask_stats_batch(img_close_inv != 0)
 
     # Get stats
-    H0 = label_img.max()
-    H1 = label_img_inv.max()
+    H0 = close_stats["num_components"]
+    H1 = close_inv_stats["num_components"]
 
-    if H0 > H1:
-        tot_particle_area = np.sum(label_img > 0)
-        average_particle_size = tot_particle_area / H0
-    else:
-        tot_particle_area = np.sum(label_img_inv > 0)
-        average_particle_size = tot_particle_area / H1
+    tot_particle_area = np.where(H0 > H1, close_stats["moments"][0], close_inv_stats["moments"][0])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average_particle_size = tot_particle_area / np.where(H0 > H1, H0, H1)
 
-    tot_perimeter = regionprops(img_close_inv.astype(int))[0]["perimeter"]
+        tot_perimeter = close_inv_stats["perimeter"]
 
-    # Make stats size invariant
-    SIA = tot_particle_area / np.size(label_img)
-    SIP = tot_perimeter / (H0 * np.sqrt(average_particle_size))
-    SIE = H0 / H1
+        # Make stats size invariant
+        SIA = tot_particle_area / (imgs.shape[1] * imgs.shape[2])
+        SIP = tot_perimeter / (H0 * np.sqrt(average_particle_size))
+        SIE = H0 / H1
 
     return SIA, SIP, SIE
 
-
 if __name__ == '__main__':
     from Models.train_CNN import validate_CNN
     from Analysis.plot_rabani import plot_random_simulated_images, cmap_rabani
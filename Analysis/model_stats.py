@@ -19,6 +19,11 @@ def plot_model_history(model):
 
 def confusion_matrix(y_truth, y_pred, cats, cmap=None, normalize=True, title=None):
     cm = metrics.confusion_matrix(y_truth, y_pred)
+
+    return plot_confusion_matrix(cm, cats, cmap, normalize, title)
+
+
+def plot_confusion_matrix(cm, cats, cmap=None, normalize=True, title=None):
     accuracy = np.trace(cm) / float(np.sum(cm))
     misclass = 1 - accuracy
 
@@ -92,13 +97,21 @@ def ROC_one_vs_all(y_preds, y_truth, cats, title=None, axis=None):
     if np.array(y_truth).ndim != 2:
         y_truth = ind_to_onehot(y_truth)
 
-    if not axis:
-        fig, axis = plt.subplots(1, 1)
-
     for i, cat in enumerate(cats):
         fpr[cat], tpr[cat], tholds[cat] = (metrics.roc_curve(
             y_truth[:, i].astype(int), y_preds[:, i]))
         roc_auc[cat] = metrics.auc(fpr[cat], tpr[cat])
+
+    _plot_ROC(fpr, tpr, roc_auc, cats, title, axis)
+
+    return tpr, fpr, tholds, roc_auc
+
+
+def _plot_ROC(fpr, tpr, roc_auc, cats, title=None, axis=None):
+    if not axis:
+        fig, axis = plt.subplots(1, 1)
+
+    for cat in cats:
         axis.plot(fpr[cat], tpr[cat], label=f'{cat}, AUC = {roc_auc[cat]:.2f}')
     axis.plot([0, 1], [0, 1], 'k--')
 
@@ -113,8 +126,6 @@ def ROC_one_vs_all(y_preds, y_truth, cats, title=None, axis=None):
     axis.set_ylim([0, 1])
     axis.legend()
 
-    return tpr, fpr, tholds, roc_auc
-
 
 def PR_one_vs_all(y_preds, y_truth, cats, title=None, axis=None):
     prec = {}
@@ -127,13 +138,21 @@ def PR_one_vs_all(y_preds, y_truth, cats, title=None, axis=None):
     if np.array(y_truth).ndim != 2:
         y_truth = ind_to_onehot(y_truth)
 
-    if not axis:
-        fig, axis = plt.subplots(1, 1)
-
     for i, cat in enumerate(cats):
         prec[cat], recall[cat], tholds[cat] = (metrics.precision_recall_curve(
             y_truth[:, i].astype(int), y_preds[:, i]))
         pr_auc[cat] = metrics.auc(recall[cat], prec[cat])
+
+    _plot_PR(prec, recall, pr_auc, cats, title, axis)
+
+    return recall, prec, tholds, pr_auc
+
+
+def _plot_PR(prec, recall, pr_auc, cats, title=None, axis=None):
+    if not axis:
+        fig, axis = plt.subplots(1, 1)
+
+    for cat in cats:
         axis.plot(prec[cat], recall[cat], label=f'{cat}, AUC = {pr_auc[cat]:.2f}')
 
     if title:
@@ -146,8 +165,6 @@ def PR_one_vs_all(y_preds, y_truth, cats, title=None, axis=None):
     axis.set_ylim([0, 1])
     axis.legend()
 
-    return recall, prec, tholds, pr_auc
-
 
 def test_classifier(model, x_test, y_true, cats, y_pred=None, average="weighted"):
     """Tests a classifier"""
@@ -182,3 +199,160 @@ def test_classifier(model, x_test, y_true, cats, y_pred=None, average="weighted"
     confusion_matrix(y_pred=y_pred_arg, y_truth=y_true_arg, cats=cats)
 
     return performance
+
+
+def test_classifier_streaming(stats, average="weighted"):
+    """Equivalent of test_classifier for a StreamingClassifierStats that has seen the whole test set"""
+    performance = stats.performance(average)
+
+    _plot_ROC(*stats.ROC_one_vs_all(), cats=stats.cats)
+    _plot_PR(*stats.PR_one_vs_all(), cats=stats.cats)
+    plot_confusion_matrix(stats.confusion_matrix, cats=stats.cats)
+
+    return performance
+
+
+class StreamingClassifierStats:
+    """
+    Accumulates classifier performance one batch at a time, so memory does not grow with the size of the test set
+
+    The confusion matrix is exact. ROC and PR curves are built from per-class histograms of the predicted scores,
+    so are exact up to the resolution of num_thresholds
+
+    Parameters
+    ----------
+    cats : list of str
+        Name of each category, in the order the classifier predicts them
+    num_thresholds : int, optional
+        Number of score bins the ROC/PR curves are evaluated over. Default 1000
+
+    See Also
+    --------
+    Analysis.model_stats.test_classifier_streaming
+    """
+
+    def __init__(self, cats, num_thresholds=1000):
+        self.cats = cats
+        self.num_thresholds = num_thresholds
+        self.num_seen = 0
+
+        self.confusion_matrix = np.zeros((len(cats), len(cats)), dtype=np.int64)
+        self._pos_score_hist = np.zeros((len(cats), num_thresholds), dtype=np.int64)
+        self._neg_score_hist = np.zeros((len(cats), num_thresholds), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        """Add a batch of one-hot (or index) truths and predicted probabilities"""
+        y_true_arg = onehot_to_ind(y_true)
+        y_pred = np.asarray(y_pred)
+        if y_pred.ndim == 1:
+            y_pred = np.eye(len(self.cats))[y_pred]
+        y_pred_arg = np.argmax(y_pred, axis=1)
+
+        self.confusion_matrix += np.bincount(y_true_arg * len(self.cats) + y_pred_arg,
+                                             minlength=len(self.cats) ** 2).reshape(len(self.cats), len(self.cats))
+
+        # Histogram each class' scores, split by whether that class was the true one
+        score_bins = np.minimum((y_pred * self.num_thresholds).astype(int), self.num_thresholds - 1)
+        score_bins += np.arange(len(self.cats)) * self.num_thresholds
+        is_pos = np.arange(len(self.cats)) == np.asarray(y_true_arg)[:, np.newaxis]
+        hist_size = len(self.cats) * self.num_thresholds
+        self._pos_score_hist += np.bincount(score_bins[is_pos], minlength=hist_size).reshape(len(self.cats), -1)
+        self._neg_score_hist += np.bincount(score_bins[~is_pos], minlength=hist_size).reshape(len(self.cats), -1)
+
+        self.num_seen += len(y_pred)
+
+    def _cumulative_counts(self):
+        """True/false positives for each class at each threshold, from the highest threshold down"""
+        zeros = np.zeros((len(self.cats), 1), dtype=np.int64)
+        tps = np.hstack((zeros, np.cumsum(self._pos_score_hist[:, ::-1], axis=1)))
+        fps = np.hstack((zeros, np.cumsum(self._neg_score_hist[:, ::-1], axis=1)))
+
+        return tps, fps
+
+    def ROC_one_vs_all(self):
+        fpr = {}
+        tpr = {}
+        roc_auc = {}
+
+        tps, fps = self._cumulative_counts()
+        for i, cat in enumerate(self.cats):
+            tpr[cat] = tps[i] / max(tps[i, -1], 1)
+            fpr[cat] = fps[i] / max(fps[i, -1], 1)
+            roc_auc[cat] = metrics.auc(fpr[cat], tpr[cat])
+
+        return fpr, tpr, roc_auc
+
+    def PR_one_vs_all(self):
+        prec = {}
+        recall = {}
+        pr_auc = {}
+
+        tps, fps = self._cumulative_counts()
+        for i, cat in enumerate(self.cats):
+            predicted_pos = tps[i] + fps[i]
+            prec[cat] = np.divide(tps[i], predicted_pos, out=np.ones(len(predicted_pos)), where=predicted_pos > 0)
+            recall[cat] = tps[i] / max(tps[i, -1], 1)
+            pr_auc[cat] = metrics.auc(recall[cat], prec[cat])
+
+        return prec, recall, pr_auc
+
+    def performance(self, average="weighted"):
+        """The same summary statistics as test_classifier, computed from the accumulated confusion matrix"""
+        if average not in ["weighted", "macro"]:
+            raise ValueError("average must be one of ['weighted', 'macro']")
+
+        cm = self.confusion_matrix
+        total = cm.sum()
+        tp = np.diag(cm).astype(float)
+        support = cm.sum(axis=1)
+        predicted = cm.sum(axis=0)
+
+        precision = np.divide(tp, predicted, out=np.zeros(len(tp)), where=predicted > 0)
+        recall = np.divide(tp, support, out=np.zeros(len(tp)), where=support > 0)
+        f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(len(tp)),
+                       where=(precision + recall) > 0)
+        jaccard = np.divide(tp, support + predicted - tp, out=np.zeros(len(tp)), where=(support + predicted - tp) > 0)
+
+        mcc_denominator = np.sqrt(float(total ** 2 - predicted @ predicted) * float(total ** 2 - support @ support))
+        mcc = (np.trace(cm) * total - support @ predicted) / mcc_denominator if mcc_denominator else 0.
+
+        weights = support / total if average == "weighted" else np.ones(len(tp)) / len(tp)
+
+        performance = {"accuracy_score": np.trace(cm) / total,
+                       "balanced_accuracy_score": np.mean(recall[support > 0]),
+                       "confusion_matrix": cm,
+                       "hamming_loss": 1 - np.trace(cm) / total,
+                       "matthews_corrcoef": mcc,
+                       f"f1_score_{average}": f1 @ weights,
+                       f"precision_score_{average}": precision @ weights,
+                       f"recall_score_{average}": recall @ weights,
+                       f"jaccard_score_{average}": jaccard @ weights}
+
+        return performance
+
+
+class StreamingReconstructionStats:
+    """Accumulates autoencoder reconstruction error one batch at a time"""
+
+    def __init__(self):
+        self.num_seen = 0
+        self._cross_entropy_sum = 0.
+        self._squared_error_sum = 0.
+        self._pixels_correct = 0
+        self._num_pixels = 0
+
+    def update(self, x_true, x_pred, eps=1e-7):
+        """Add a batch of clean images and their reconstructions"""
+        x_true = np.asarray(x_true, dtype=np.float64)
+        x_pred = np.clip(np.asarray(x_pred, dtype=np.float64), eps, 1 - eps)
+
+        self._cross_entropy_sum -= np.sum(x_true * np.log(x_pred) + (1 - x_true) * np.log(1 - x_pred))
+        self._squared_error_sum += np.sum((x_true - x_pred) ** 2)
+        self._pixels_correct += np.count_nonzero(np.round(x_pred) == x_true)
+        self._num_pixels += x_true.size
+        self.num_seen += len(x_true)
+
+    def performance(self):
+        return {"binary_crossentropy": self._cross_entropy_sum / self._num_pixels,
+                "mean_squared_error": self._squared_error_sum / self._num_pixels,
+                "pixel_accuracy": self._pixels_correct / self._num_pixels}
@@ -25,7 +25,7 @@ def dualscale_plot(xaxis, yaxis, root_dir, num_axis_ticks=15, trained_model=None
     """Plot two variables against another, and optionally the CNN predictions"""
 
     from Models.h5_iterator import h5RabaniDataGenerator
-    files = os.listdir(root_dir)
+    files = [file for file in os.listdir(root_dir) if file.endswith(".h5")]
 
     # Find axis details to allow for preallocation
     x_range_all = np.zeros((len(files),))
@@ -157,7 +157,7 @@ def plot_threshold_selection(root_dir, categories, img_res, plot_config=(5, 5),
     """Plot a selection of images between a range of normalised euler numbers,
     to eventually determine training labels"""
     # Setup and parse input
-    files = os.listdir(root_dir)
+    files = [file for file in os.listdir(root_dir) if file.endswith(".h5")]
 
     fig, axs = plt.subplots(1, len(categories), sharex=True, sharey=True)
 
@@ -215,7 +215,7 @@ def plot_random_simulated_images(datadir, num_imgs, y_params, y_cats, imsize=128
                                           output_parameters_list=y_params, output_categories_list=y_cats)
     img_generator.is_validation_set = True
 
-    x, y = img_generator.__getitem__(None)
+    x, y = img_generator.__getitem__(0)
     axis_res = int(np.sqrt(num_imgs))
 
     plt.figure()
@@ -0,0 +1,175 @@
+"""
+Numba kernels for the few region properties the Rabani analysis needs (Euler number, perimeter, moments and number
+of connected components), for whole batches of binary masks at once, rather than every property skimage's
+regionprops computes
+"""
+
+import numpy as np
+from numba import jit, prange
+
+
+def mask_stats_batch(masks):
+    """
+    Region statistics of every mask in a (N x H x W) stack, in parallel over the stack
+
+    Each mask is treated as a single region, as skimage.measure.regionprops treats each label
+
+    Parameters
+    ----------
+    masks : ndarray
+        (N x H x W) stack of binary masks
+
+    Returns
+    -------
+    stats : dict
+        "euler_number" (8-connected), "perimeter" (4-connected, as skimage.measure.perimeter), "num_components"
+        (8-connected, as skimage.measure.label) and "moments", the raw moments (m00, m10, m01, m20, m02, m11)
+    """
+    masks = np.ascontiguousarray(masks, dtype=np.uint8)
+    euler_nums, perimeters, num_components, moments = _mask_stats_batch(masks)
+
+    return {"euler_number": euler_nums, "perimeter": perimeters, "num_components": num_components,
+            "moments": tuple(moments.T)}
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _mask_stats_batch(masks):
+    num_masks = masks.shape[0]
+    euler_nums = np.zeros(num_masks, dtype=np.int64)
+    perimeters = np.zeros(num_masks)
+    num_components = np.zeros(num_masks, dtype=np.int64)
+    moments = np.zeros((num_masks, 6), dtype=np.int64)
+
+    for i in prange(num_masks):
+        euler_nums[i] = _euler_number(masks[i])
+        perimeters[i] = _perimeter(masks[i])
+        num_components[i] = _label(masks[i])[1]
+        moments[i] = _moments(masks[i])
+
+    return euler_nums, perimeters, num_components, moments
+
+
+@jit(nopython=True, cache=True)
+def _pixel(mask, row, col):
+    """mask[row, col], or 0 outside of the mask"""
+    if 0 <= row < mask.shape[0] and 0 <= col < mask.shape[1]:
+        return mask[row, col]
+    return 0
+
+
+@jit(nopython=True, cache=True)
+def _euler_number(mask):
+    """8-connected Euler number from bit-quad counts, (Q1 - Q3 - 2 * QD) / 4, over the zero-padded mask"""
+    quad_sum = 0
+    for row in range(-1, mask.shape[0]):
+        for col in range(-1, mask.shape[1]):
+            top_left = _pixel(mask, row, col)
+            top_right = _pixel(mask, row, col + 1)
+            bottom_left = _pixel(mask, row + 1, col)
+            bottom_right = _pixel(mask, row + 1, col + 1)
+
+            num_set = top_left + top_right + bottom_left + bottom_right
+            if num_set == 1:
+                quad_sum += 1
+            elif num_set == 3:
+                quad_sum -= 1
+            elif num_set == 2 and top_left == bottom_right:
+                quad_sum -= 2
+
+    return quad_sum // 4
+
+
+@jit(nopython=True, cache=True)
+def _perimeter(mask):
+    """
+    4-connected perimeter, as skimage.measure.perimeter. Border pixels (set pixels with an unset 4-neighbour) are
+    weighted by the pattern of border pixels around them
+    """
+    num_rows, num_cols = mask.shape
+    border = np.zeros((num_rows, num_cols), dtype=np.uint8)
+    for row in range(num_rows):
+        for col in range(num_cols):
+            if mask[row, col] and not (_pixel(mask, row - 1, col) and _pixel(mask, row + 1, col) and
+                                       _pixel(mask, row, col - 1) and _pixel(mask, row, col + 1)):
+                border[row, col] = 1
+
+    perimeter = 0.
+    for row in range(num_rows):
+        for col in range(num_cols):
+            if not border[row, col]:
+                continue
+
+            code = 1 + 2 * (_pixel(border, row - 1, col) + _pixel(border, row + 1, col) +
+                            _pixel(border, row, col - 1) + _pixel(border, row, col + 1)) + \
+                10 * (_pixel(border, row - 1, col - 1) + _pixel(border, row - 1, col + 1) +
+                      _pixel(border, row + 1, col - 1) + _pixel(border, row + 1, col + 1))
+
+            if code == 5 or code == 7 or code == 15 or code == 17 or code == 25 or code == 27:
+                perimeter += 1
+            elif code == 21 or code == 33:
+                perimeter += np.sqrt(2)
+            elif code == 13 or code == 23:
+                perimeter += (1 + np.sqrt(2)) / 2
+
+    return perimeter
+
+
+@jit(nopython=True, cache=True)
+def _find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+@jit(nopython=True, cache=True)
+def _label(mask):
+    """8-connected labelling by union-find, with labels numbered from 1 in raster order, as skimage.measure.label"""
+    num_rows, num_cols = mask.shape
+    parents = np.arange(num_rows * num_cols)
+
+    # Join each set pixel to its already visited neighbours
+    for row in range(num_rows):
+        for col in range(num_cols):
+            if not mask[row, col]:
+                continue
+            pixel = row * num_cols + col
+            for d_row, d_col in ((-1, -1), (-1, 0), (-1, 1), (0, -1)):
+                if _pixel(mask, row + d_row, col + d_col):
+                    root = _find(parents, (row + d_row) * num_cols + col + d_col)
+                    pixel_root = _find(parents, pixel)
+                    if root != pixel_root:
+                        parents[max(root, pixel_root)] = min(root, pixel_root)
+
+    # The smallest pixel of each component is its root, so roots are met in raster order
+    labels = np.zeros((num_rows, num_cols), dtype=np.int64)
+    root_labels = np.zeros(num_rows * num_cols, dtype=np.int64)
+    num_labels = 0
+    for row in range(num_rows):
+        for col in range(num_cols):
+            if not mask[row, col]:
+                continue
+            root = _find(parents, row * num_cols + col)
+            if root_labels[root] == 0:
+                num_labels += 1
+                root_labels[root] = num_labels
+            labels[row, col] = root_labels[root]
+
+    return labels, num_labels
+
+
+@jit(nopython=True, cache=True)
+def _moments(mask):
+    """Raw moments (m00, m10, m01, m20, m02, m11), with rows as the first coordinate"""
+    moments = np.zeros(6, dtype=np.int64)
+    for row in range(mask.shape[0]):
+        for col in range(mask.shape[1]):
+            if mask[row, col]:
+                moments[0] += 1
+                moments[1] += row
+                moments[2] += col
+                moments[3] += row * row
+                moments[4] += col * col
+                moments[5] += row * col
+
+    return moments
@@ -39,9 +39,20 @@ def adding_noise_test(img, model, cats, noise_steps, perc_noise, perc_std, saved
             plt.savefig(f"{savedir}/img_{i}.png")
 
 
+def _window_euler_and_perimeters(windows):
+    """Euler number and perimeter of the nonzero pixels of each window, normalised by the number of 1 pixels"""
+    from skimage import measure
+    from Analysis.image_stats import region_euler_numbers_batch
+
+    num_ones = np.sum(windows == 1, axis=(1, 2))
+    euler_nums = region_euler_numbers_batch(windows, last_region=True) / num_ones
+    perimeters = np.array([measure.perimeter(img != 0) for img in windows]) / num_ones
+
+    return euler_nums, perimeters
+
+
 def everything_test(filepath, window_size, num_steps, perc_noise):
     from Filters.screening import FileFilter
-    from skimage import measure
     from Analysis.plot_rabani import show_image
     from Models.h5_iterator import h5RabaniDataGenerator
     from matplotlib.ticker import PercentFormatter
@@ -55,12 +66,7 @@ def everything_test(filepath, window_size, num_steps, perc_noise):
     wrapped_arr_for_noise = wrapped_arr.copy()
 
     # Calculate stats as function of window num
-    euler_nums = np.zeros(len(wrapped_arr))
-    perimeters = np.zeros(len(wrapped_arr))
-    for i, img in enumerate(tqdm(wrapped_arr)):
-        region = measure.regionprops((img[:, :, 0] != 0) + 1)[1]
-        euler_nums[i] = region["euler_number"] / np.sum(img == 1)
-        perimeters[i] = region["perimeter"] / np.sum(img == 1)
+    euler_nums, perimeters = _window_euler_and_perimeters(wrapped_arr[:, :, :, 0])
 
     # Calculate stats as function of noise
     euler_nums_noise = np.zeros(num_steps)
@@ -68,12 +74,7 @@ def everything_test(filepath, window_size, num_steps, perc_noise):
     euler_nums_noise_std = np.zeros(num_steps)
     perimeters_noise_std = np.zeros(num_steps)
     for i in tqdm(range(num_steps)):
-        euler_nums_noise_step = np.zeros(len(wrapped_arr))
-        perimeters_noise_step = np.zeros(len(wrapped_arr))
-        for j, img in enumerate(wrapped_arr_for_noise):
-            region = measure.regionprops((img[:, :, 0] != 0) + 1)[1]
-            euler_nums_noise_step[j] = region["euler_number"] / np.sum(img == 1)
-            perimeters_noise_step[j] = region["perimeter"] / np.sum(img == 1)
+        euler_nums_noise_step, perimeters_noise_step = _window_euler_and_perimeters(wrapped_arr_for_noise[:, :, :, 0])
 
         euler_nums_noise[i] = np.mean(euler_nums_noise_step)
         euler_nums_noise_std[i] = np.std(euler_nums_noise_step)
@@ -243,6 +244,95 @@ def test_minkowski_scale_invariance(img, stride=8, max_subimgs=20):
     fig.tight_layout()
 
 
+def _random_blob_images(num_imgs, imsize, num_levels, rng):
+    """
+    Smoothed noise split into num_levels levels of random proportions, with blobs of random size, so images have
+    Rabani-like regions, holes and islands
+    """
+    from scipy import ndimage
+
+    imgs = np.zeros((num_imgs, imsize, imsize), dtype=int)
+    for img in imgs:
+        noise = ndimage.gaussian_filter(rng.random((imsize, imsize)), sigma=rng.uniform(0.5, 4))
+        fractions = np.sort(rng.uniform(0.05, 0.95, num_levels - 1))
+        img[:] = np.sum(noise > np.quantile(noise, fractions)[:, np.newaxis, np.newaxis], axis=0)
+
+    return imgs
+
+
+def test_region_stats_against_skimage(num_imgs=200, imsize=64, seed=0):
+    """
+    Check the numba region stats of Analysis.region_stats, and calculate_stats/calculate_normalised_stats built on
+    them, against skimage's regionprops on random images. Raises AssertionError on any disagreement
+    """
+    from scipy.stats import mode
+    from skimage import measure, morphology
+    from Analysis.image_stats import calculate_stats_batch, calculate_normalised_stats_batch, \
+        shape_stats_from_moments
+    from Analysis.region_stats import mask_stats_batch
+
+    rng = np.random.default_rng(seed)
+
+    # Region properties of single masks, from white noise and blobs
+    masks = np.concatenate([rng.random((num_imgs, imsize, imsize)) < 0.5,
+                            _random_blob_images(num_imgs, imsize, 2, rng).astype(bool)])
+    stats = mask_stats_batch(masks)
+    eccentricity, _ = shape_stats_from_moments(*stats["moments"])
+    regions = [measure.regionprops(mask.astype(int))[0] for mask in masks]
+    assert np.array_equal(stats["euler_number"], [region["euler_number"] for region in regions]), "Euler number"
+    assert np.allclose(stats["perimeter"], [region["perimeter"] for region in regions]), "Perimeter"
+    assert np.allclose(eccentricity, [region["eccentricity"] for region in regions]), "Eccentricity"
+    assert np.array_equal(stats["moments"][0], [region["area"] for region in regions]), "Area"
+    assert np.array_equal(stats["num_components"], [measure.label(mask).max() for mask in masks]), \
+        "Number of components"
+
+    # calculate_stats, as it was with regionprops
+    imgs = _random_blob_images(num_imgs, imsize, 3, rng)
+    regions, cats = calculate_stats_batch(imgs, imsize)
+    for i, img in enumerate(imgs):
+        region = measure.regionprops((img != 0) + 1)[0]
+        for key in ["euler_number", "perimeter", "eccentricity", "area"]:
+            assert np.isclose(regions[key][i], region[key]), f"calculate_stats {key}"
+
+        normalised_euler = region["euler_number"] / np.sum(img == 2)
+        if int(mode(img, axis=None).mode) == 1:
+            cat = "hole" if np.sum(img == 0) / imsize ** 2 >= 0.02 else "liquid"
+        elif -0.00025 <= normalised_euler:
+            cat = "cellular"
+        elif -0.01 <= normalised_euler < -0.001:
+            cat = "labyrinth"
+        elif normalised_euler <= -0.03:
+            cat = "island"
+        else:
+            cat = "none"
+        assert cats[i] == cat, "calculate_stats category"
+
+    # calculate_normalised_stats, as it was with skimage's closing, label and regionprops
+    imgs = _random_blob_images(num_imgs, imsize, 2, rng)
+    SIA, SIP, SIE = calculate_normalised_stats_batch(imgs)
+    for i, img in enumerate(imgs):
+        img_close = morphology.closing(img, np.ones((3, 3)))
+        img_close_inv = np.abs(1 - img_close)
+        if not img_close_inv.any():
+            # Closed into a single region, so regionprops has no perimeter to compare with
+            continue
+        label_img = measure.label(img_close)
+        label_img_inv = measure.label(img_close_inv)
+        H0 = label_img.max()
+        H1 = label_img_inv.max()
+        if H0 > H1:
+            tot_particle_area = np.sum(label_img > 0)
+            average_particle_size = tot_particle_area / H0
+        else:
+            tot_particle_area = np.sum(label_img_inv > 0)
+            average_particle_size = tot_particle_area / H1
+        tot_perimeter = measure.regionprops(img_close_inv.astype(int))[0]["perimeter"]
+
+        assert np.isclose(SIA[i], tot_particle_area / np.size(label_img)), "SIA"
+        assert np.isclose(SIP[i], tot_perimeter / (H0 * np.sqrt(average_particle_size))), "SIP"
+        assert np.isclose(SIE[i], H0 / H1), "SIE"
+
+
 def test_filtering_fail_reasons(csv_path, classifier_type="CNN"):
     dframe = ensure_dframe_is_pandas(csv_path)
 
@@ -351,4 +441,8 @@ def plot_regression_3d(sklearn_model, cats, dframe_path):
     ax.set_ylabel("Log SIP")
     ax.set_zlabel("Log SIE")
 
-    ax.legend(sc.legend_elements()[0], cats)
\ No newline at end of file
+    ax.legend(sc.legend_elements()[0], cats)
+
+
+if __name__ == '__main__':
+    test_region_stats_against_skimage()
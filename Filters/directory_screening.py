@@ -1,11 +1,10 @@
 import glob
 
 import pandas as pd
-from tensorflow.python.keras.models import load_model
 from tqdm import tqdm
 
-from Filters.screening import FileFilter
-from Models.train_regression import load_sklearn_model
+from Filters.screening_pipeline import ScreeningPipeline
+from Models.registry import get_trained_model
 from Models.utils import make_pd_nans_identical
 
 IMAGE_DIR = "/home/mltest1/tmp/pycharm_project_883/Data/Classification_Performance_Images/Good_Images"#"/home/mltest1/tmp/pycharm_project_883/Data/Steff_Images/Raw"#"/media/mltest1/Dat Storage/Manu AFM CD Box" #
@@ -14,13 +13,15 @@ DENOISER_DIR = "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks/2020
 MINKOWSKI_DIR = "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks/2020-07-28--11-15/model.p"
 OUTPUT_DIR = "/home/mltest1/tmp/pycharm_project_883/Data/Classification_Performance_Images/Final"
 ASSESS_EULER = False
+ADAPTIVE_CNN = False  # Stop classifying windows once the CNN vote is settled
+CNN_WINDOW_BUDGET = None
+CHUNK_SIZE = 16  # Files whose windows are CNN classified together, so the model always gets full batches
+CNN_BATCH_SIZE = 256
+NUM_LOADERS = 4  # Threads loading files
+NUM_PREPROCESSORS = None  # Processes preprocessing files (None for one per core)
+QUEUE_SIZE = 32  # Most files waiting between pipeline stages
 SEARCH_RECURSIVE = True
 
-# Load models
-cnn_model = None#load_model(CNN_DIR)
-denoiser_model = load_model(DENOISER_DIR)
-sklearn_model = load_sklearn_model(MINKOWSKI_DIR)
-
 df_summary = pd.DataFrame(
     columns=["File Path", "Resolution", "Size (m)", "Fail Reasons",
              "CNN Classification", "CNN Mean", "CNN std",
@@ -28,18 +29,9 @@ df_summary = pd.DataFrame(
              "Stats Regression Classification", "Stats Regression Mean", "Stats Regression std",
              "Manual Classification", "SIA", "SIP", "SIE"])
 
-# Filter every ibw file in the directory, and build up a dataframe
-all_files = [f for f in glob.glob(f"{IMAGE_DIR}/**/*.ibw", recursive=SEARCH_RECURSIVE)]
-
-t = tqdm(total=len(all_files), smoothing=True)
-for i, file in enumerate(all_files):
-    t.set_description(f"...{file[-25:]}")
 
-    filterer = FileFilter()
-    filterer.assess_file(filepath=file, threshold_method="multiotsu",
-                         category_model=None, denoising_model=denoiser_model, minkowski_model=sklearn_model,
-                         assess_euler=ASSESS_EULER, nbins=1000)#, savedir=f"{OUTPUT_DIR}/Filtered")
 
+def summarise_file(i, file, filterer):
     df_summary.loc[i, ["File Path"]] = [file]
     df_summary.loc[i, ["Resolution"]] = [filterer.image_res]
     df_summary.loc[i, ["Size (m)"]] = [filterer.image_size]
@@ -61,8 +53,28 @@ for i, file in enumerate(all_files):
         df_summary.loc[i, ["Stats Regression Mean"]] = [filterer.image_classifier.minkowski_preds.mean(axis=0)]
         df_summary.loc[i, ["Stats Regression std"]] = [filterer.image_classifier.minkowski_preds.std(axis=0)]
 
-    del filterer  # Just to be safe!
-    t.update(1)
 
-df_summary = make_pd_nans_identical(df_summary)
-df_summary.to_csv(f"{OUTPUT_DIR}/good_classifications_minkowski_newstats.csv", index=False)
+if __name__ == '__main__':
+    # Load models (once per process)
+    cnn_model = None#get_trained_model(CNN_DIR)
+    denoiser_model = get_trained_model(DENOISER_DIR)
+    sklearn_model = get_trained_model(MINKOWSKI_DIR)
+
+    # Filter every ibw file in the directory, and build up a dataframe
+    all_files = [f for f in glob.glob(f"{IMAGE_DIR}/**/*.ibw", recursive=SEARCH_RECURSIVE)]
+
+    pipeline = ScreeningPipeline(threshold_method="multiotsu", category_model=cnn_model,
+                                 denoising_model=denoiser_model, minkowski_model=sklearn_model,
+                                 assess_euler=ASSESS_EULER, adaptive_cnn=ADAPTIVE_CNN,
+                                 cnn_window_budget=CNN_WINDOW_BUDGET, num_loaders=NUM_LOADERS,
+                                 num_preprocessors=NUM_PREPROCESSORS, queue_size=QUEUE_SIZE, chunk_size=CHUNK_SIZE,
+                                 cnn_batch_size=CNN_BATCH_SIZE, nbins=1000)#, savedir=f"{OUTPUT_DIR}/Filtered")
+
+    t = tqdm(total=len(all_files), smoothing=True)
+    for i, file, filterer in pipeline.run(all_files):
+        t.set_description(f"...{file[-25:]}")
+        summarise_file(i, file, filterer)
+        t.update(1)
+
+    df_summary = make_pd_nans_identical(df_summary)
+    df_summary.to_csv(f"{OUTPUT_DIR}/good_classifications_minkowski_newstats.csv", index=False)
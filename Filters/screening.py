@@ -6,17 +6,50 @@ import pycroscopy as scope
 import skimage
 from matplotlib import pyplot as plt
 from scipy import stats, ndimage, signal
-from tensorflow.python.keras.models import load_model
 
 from Analysis.plot_rabani import show_image, cmap_rabani
-from Models.predict import ImageClassifier
+from Models.predict import ImageClassifier, denoise_image, cnn_classify_batch
+from Models.quantise import select_runtime
 from Analysis.model_stats import preds_pie, preds_histogram
-from Models.train_regression import load_sklearn_model
+from Models.registry import get_trained_model
 
 
 class FileFilter:
-    def __init__(self):
-        self._igor_translator = scope.io.translators.IgorIBWTranslator(max_mem_mb=1024)
+    def __init__(self, adaptive_cnn=False, cnn_window_budget=None, defer_cnn=False, runtime="keras",
+                 calibration_generator=None, denoiser_calibration_generator=None, igor_translator=None):
+        """
+        Parameters
+        ----------
+        adaptive_cnn: bool, optional
+            Stop CNN classification once its confidence checks are settled, rather than classifying every window.
+            See ImageClassifier.adaptive_cnn_classify. Default False
+        cnn_window_budget: int or None, optional
+            Most windows to classify when adaptive_cnn is set. Default None (no limit)
+        defer_cnn: bool, optional
+            Leave CNN classification of the windows to the caller, e.g. cnn_classify_deferred over many files at
+            once. Default False
+        runtime: str, optional
+            Run the category and denoising models with Keras ("keras", default) or as quantised TFLite models
+            ("tflite"). See Models.quantise.select_runtime. Without calibration generators, only the weights are
+            quantised. Models already exported to .tflite can be passed in instead (see Models.registry)
+        calibration_generator: Sequence or None, optional
+            Classifier data (e.g. h5RabaniDataGenerator with network_type="classifier") to calibrate full int8
+            quantisation of the category model with. Default None
+        denoiser_calibration_generator: Sequence or None, optional
+            As calibration_generator, for the denoising model (network_type="autoencoder"). Default None
+        igor_translator: pycroscopy IgorIBWTranslator or None, optional
+            Translator to load .ibw files with, so one can be shared by many files. Default None (make a new one)
+        """
+        self.adaptive_cnn = adaptive_cnn
+        self.cnn_window_budget = cnn_window_budget
+        self.defer_cnn = defer_cnn
+        self.runtime = runtime
+        self.calibration_generator = calibration_generator
+        self.denoiser_calibration_generator = denoiser_calibration_generator
+        self.is_awaiting_cnn = False
+        self.cnn_min_confidence = 0.8
+        self.cnn_max_std = 0.2
+        self._igor_translator = igor_translator or scope.io.translators.IgorIBWTranslator(max_mem_mb=1024)
         self.image_res = self.image_size = None
         self.image_classifier = None
         self.normalised_euler = None
@@ -53,7 +86,8 @@ class FileFilter:
         plot: bool, optional
             If we should plot the results of preprocessing/assessment. Default False
         savedir: None or str, optional
-            If a string, save the plot to the given directory. Default None
+            If a string, save the plot to the given directory. Default None. Can't be used with defer_cnn, as the
+            plot would be made before the CNN classification (see Filters.screening_pipeline.ScreeningPipeline)
 
         Examples
         --------
@@ -61,6 +95,9 @@ class FileFilter:
         >>> filterer.assess_file()
         """
 
+        if self.defer_cnn and category_model and (plot or savedir):
+            raise ValueError("Can't plot before deferred CNN classification. Plot after assess_cnn_preds instead")
+
         self.filepath = filepath
         denoised_arr = None
 
@@ -69,8 +106,8 @@ class FileFilter:
             binarized_data_for_plotting = self._load_and_preprocess(filepath, threshold_method, **kwargs)
 
             if binarized_data is not None:
-                assessment_arr, denoised_arr = self._classify(binarized_data, denoising_model,
-                                                              category_model, assess_euler, minkowski_model)
+                assessment_arr, denoised_arr = self.classify(binarized_data, denoising_model,
+                                                             category_model, assess_euler, minkowski_model)
 
         except:
             self._add_fail_reason("Unexpected error")
@@ -83,9 +120,48 @@ class FileFilter:
             if not plot:
                 plt.close("all")
 
+    # The translator and calibration data may not pickle, and aren't needed to preprocess, so aren't sent to
+    # preprocessing processes
+    _unpickled_attrs = ("_igor_translator", "calibration_generator", "denoiser_calibration_generator")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._unpickled_attrs:
+            state[attr] = None
+        return state
+
+    def _update_from_copy(self, filterer_copy):
+        """Take on the results of a copy of this filterer (e.g. back from a preprocessing process)"""
+        self.__dict__.update({attr: value for attr, value in filterer_copy.__dict__.items()
+                              if attr not in self._unpickled_attrs})
+
     def _load_and_preprocess(self, filepath, threshold_method, **kwargs):
-        data = norm_data = phase = median_data = flattened_data = \
-            binarized_data_for_plotting = binarized_data = assessment_arr = None
+        norm_data = median_data = flattened_data = binarized_data_for_plotting = assessment_arr = None
+
+        data, phase, binarized_data = self.load(filepath)
+        if data is not None and not self.fail_reasons:
+            norm_data, median_data, flattened_data, binarized_data = self.preprocess(data, threshold_method, **kwargs)
+
+        return data, phase, norm_data, median_data, flattened_data, \
+               binarized_data, assessment_arr, binarized_data_for_plotting
+
+    def load(self, filepath):
+        """Load a .ibw scan or .png image, the I/O bound first stage of assess_file.
+
+        Parameters
+        ----------
+        filepath: str
+            Path to a .ibw or .png file
+
+        Returns
+        -------
+        data, phase: ndarray or None
+            Height and phase channels of a .ibw scan. None for .png files or if the file is corrupt
+        binarized_data: ndarray or None
+            A .png image, which is already binarised. None for .ibw files
+        """
+        self.filepath = filepath
+        data = phase = binarized_data = None
 
         filetype = os.path.splitext(filepath)[1][1:]
 
@@ -96,39 +172,65 @@ class FileFilter:
                 data, phase = self._parse_ibw_file(h5_file)
                 self._is_scan_complete(data)
 
-            if not self.fail_reasons:
-                norm_data = self._normalize_data(data)
-                median_data = self._median_align(norm_data)
-                self._is_image_noisy(median_data)
-                flattened_data = self._poly_plane_flatten(median_data)
-                flattened_data = self._normalize_data(flattened_data)
-                binarized_data = self._binarise(method=threshold_method, arr=flattened_data, **kwargs)
-                if binarized_data is not None:
-                    self._are_lines_properly_binarised(binarized_data)
-
         elif filetype == "png":
             binarized_data = self._load_image_file(filepath)
 
-        return data, phase, norm_data, median_data, flattened_data, \
-               binarized_data, assessment_arr, binarized_data_for_plotting
+        return data, phase, binarized_data
+
+    def preprocess(self, data, threshold_method, **kwargs):
+        """Level, flatten and binarise a loaded scan, the CPU bound second stage of assess_file.
+
+        Parameters
+        ----------
+        data: ndarray
+            Height channel from FileFilter.load
+        threshold_method: str
+            As for FileFilter.assess_file
+
+        Returns
+        -------
+        norm_data, median_data, flattened_data: ndarray
+            Scan after each step of preprocessing
+        binarized_data: ndarray or None
+            Binarised scan, or None if it couldn't be binarised
+        """
+        norm_data = self._normalize_data(data)
+        median_data = self._median_align(norm_data)
+        self._is_image_noisy(median_data)
+        flattened_data = self._poly_plane_flatten(median_data)
+        flattened_data = self._normalize_data(flattened_data)
+        binarized_data = self._binarise(method=threshold_method, arr=flattened_data, **kwargs)
+        if binarized_data is not None:
+            self._are_lines_properly_binarised(binarized_data)
+
+        return norm_data, median_data, flattened_data, binarized_data
 
-    def _classify(self, arr, denoising_model, category_model, assess_euler, minkowski_model):
-        if denoising_model and category_model:
+    def classify(self, arr, denoising_model, category_model, assess_euler, minkowski_model):
+        """Denoise and classify a binarised image, the model bound last stage of assess_file.
+
+        Parameters are as for FileFilter.assess_file, with arr the binarised image. Returns the image that was
+        classified (denoised if denoising_model is given) and the denoised image (or None)
+        """
+        # An any-size (e.g. TFLite) denoiser fits any classifier
+        if denoising_model and category_model and None not in denoising_model.input_shape[1:3]:
             assert category_model.input_shape == denoising_model.input_shape, \
                 "Classifier and denoiser must have consistent input shape"
 
         if denoising_model:
-            arr = self._wrap_image_to_tensorflow(arr, denoising_model.input_shape[1])
-            assessment_arr = self._denoise(arr, denoising_model)
-            denoised_arr = None    #ImageClassifier._unwrap_image_from_tensorflow(assessment_arr, self.image_res)
+            # Windows are cut from the denoised image, rather than each window denoised separately
+            denoised_arr = self._denoise(arr, denoising_model)
+            assessment_arr = denoised_arr
         else:
             assessment_arr = arr
             denoised_arr = None
 
-        self.image_classifier = ImageClassifier(assessment_arr, category_model, minkowski_model)
-        self._is_image_homogenous(self.image_classifier.cnn_arr)
+        self.image_classifier = ImageClassifier(assessment_arr, category_model, minkowski_model, runtime=self.runtime,
+                                                calibration_generator=self.calibration_generator)
+        self._is_image_homogenous(self.image_classifier)
 
-        if category_model:
+        if category_model and self.defer_cnn:
+            self.is_awaiting_cnn = True
+        elif category_model:
             self._CNN_classify()
 
         if assess_euler:
@@ -389,16 +491,9 @@ class FileFilter:
 
         return are_lines_properly_binarised
 
-    def _is_image_homogenous(self, wrapped_arr):
-        euler_nums = np.zeros(len(wrapped_arr))
-        eccentricities = np.zeros(len(wrapped_arr))
-        equiv_diameters = np.zeros(len(wrapped_arr))
-
-        for i, img in enumerate(wrapped_arr[:, :, :, 0]):
-            region = skimage.measure.regionprops((img != 0) + 1)[-1]
-            euler_nums[i] = region["euler_number"] / np.sum(img == 1)
-            eccentricities[i] = region["eccentricity"]
-            equiv_diameters[i] = region["equivalent_diameter"]
+    def _is_image_homogenous(self, image_classifier):
+        euler_nums = image_classifier.window_euler_numbers(last_region=True) / image_classifier.window_level_counts(1)
+        eccentricities, equiv_diameters = image_classifier.window_region_shapes()
 
         if not 0.05 >= euler_nums.mean() >= -0.05:
             self._add_fail_reason("Euler Wrong Range")
@@ -418,17 +513,30 @@ class FileFilter:
         return ImageClassifier._wrap_image_to_tensorflow(img, network_img_size, jump_size, zigzag)
 
     def _denoise(self, arr, denoising_model):
-        return np.round(denoising_model.predict(arr))
+        denoising_model = select_runtime(denoising_model, self.runtime, self.denoiser_calibration_generator,
+                                         any_size=True)
+        return denoise_image(arr, denoising_model)
 
     def _CNN_classify(self):
-        self.image_classifier.cnn_classify()
+        if self.adaptive_cnn:
+            self.image_classifier.adaptive_cnn_classify(max_windows=self.cnn_window_budget,
+                                                        mean_threshold=self.cnn_min_confidence,
+                                                        std_threshold=self.cnn_max_std)
+        else:
+            self.image_classifier.cnn_classify()
+
+        self.assess_cnn_preds()
+
+    def assess_cnn_preds(self):
+        """Check and record the CNN classification, once image_classifier has its cnn_preds"""
+        self.is_awaiting_cnn = False
 
         # For each class find the mean CNN_classification
         max_class = int(np.argmax(self.image_classifier.cnn_majority_preds))
 
-        if np.max(self.image_classifier.cnn_majority_preds) < 0.8:
+        if np.max(self.image_classifier.cnn_majority_preds) < self.cnn_min_confidence:
             self._add_fail_reason("CNN not confident enough")
-        if np.any(np.std(self.image_classifier.cnn_preds, axis=0) > 0.2):
+        if np.any(np.std(self.image_classifier.cnn_preds, axis=0) > self.cnn_max_std):
             self._add_fail_reason("CNN distributions too broad")
         # if np.sum(self.image_classifier.cnn_preds[:, max_class] >= 0.9999) > (0.98 * len(
         #         self.image_classifier.cnn_preds)):
@@ -462,12 +570,47 @@ class FileFilter:
         self.minkowski_classification = self.minkowski_cats[max_class]
 
 
+def cnn_classify_deferred(filterers, batch_size=256):
+    """
+    CNN classify the windows of every FileFilter awaiting CNN classification (made with defer_cnn=True) in shared
+    batches, then assess each one. If the shared batches fail, each file is classified separately, and a file that
+    still fails gets an "Unexpected error" fail reason, as in FileFilter.assess_file
+
+    Parameters
+    ----------
+    filterers: list of FileFilter
+        Filterers that have assessed their file. Those not awaiting CNN classification are ignored
+    batch_size: int, optional
+        Number of windows per batch. Default 256
+    """
+    to_classify = [filterer for filterer in filterers if filterer.is_awaiting_cnn]
+    if not to_classify:
+        return
+
+    try:
+        cnn_classify_batch([filterer.image_classifier for filterer in to_classify], batch_size=batch_size)
+    except:
+        for filterer in to_classify:
+            try:
+                filterer.image_classifier.cnn_classify()
+            except:
+                filterer._add_fail_reason("Unexpected error")
+                filterer.is_awaiting_cnn = False
+
+    for filterer in to_classify:
+        if not filterer.is_awaiting_cnn:
+            continue
+        try:
+            filterer.assess_cnn_preds()
+        except:
+            filterer._add_fail_reason("Unexpected error")
+            filterer.is_awaiting_cnn = False
+
+
 if __name__ == '__main__':
-    cat_model = load_model(
-        "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks/2020-06-15--12-18/model.h5")
-    denoise_model = load_model(
-        "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks/2020-05-29--14-07/model.h5")
-    sklearn_model = load_sklearn_model(
+    cat_model = get_trained_model("classifier")
+    denoise_model = get_trained_model("denoiser")
+    sklearn_model = get_trained_model(
         "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks/2020-07-27--16-20/model.p")
 
     ims = [
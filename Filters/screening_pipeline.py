@@ -0,0 +1,273 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pycroscopy as scope
+from matplotlib import pyplot as plt
+
+from Filters.screening import FileFilter, cnn_classify_deferred
+
+# Marks the end of the files on a queue
+_END = None
+
+
+class ScreeningPipeline:
+    def __init__(self, threshold_method="multiotsu", category_model=None, denoising_model=None, minkowski_model=None,
+                 assess_euler=False, adaptive_cnn=False, cnn_window_budget=None, runtime="keras",
+                 calibration_generator=None, denoiser_calibration_generator=None, num_loaders=4,
+                 num_preprocessors=None, queue_size=32, chunk_size=16, cnn_batch_size=256, savedir=None, **kwargs):
+        """
+        Screen many files with FileFilter, overlapping the stages of FileFilter.assess_file across files:
+
+        1. Load - .ibw files are translated by a pool of I/O threads, each with its own IgorIBWTranslator
+        2. Preprocess - levelling, flattening and binarisation run in a pool of processes
+        3. Classify - denoising and classification run in the calling process, which holds the models, with the
+           windows of chunk_size files CNN classified together (see Filters.screening.cnn_classify_deferred)
+
+        Stages are joined by queues of at most queue_size files, so a slow stage holds up those before it rather
+        than filling memory. As in FileFilter.assess_file, a file that fails in any stage (including a crashed
+        preprocessing process) gets an "Unexpected error" fail reason, and screening carries on
+
+        Parameters
+        ----------
+        threshold_method, category_model, denoising_model, minkowski_model, assess_euler
+            As for FileFilter.assess_file
+        adaptive_cnn, cnn_window_budget, runtime, calibration_generator, denoiser_calibration_generator
+            As for FileFilter. Adaptive classification stops each file early, so isn't batched across files
+        num_loaders : int, optional
+            Number of loading threads. Default 4
+        num_preprocessors : int or None, optional
+            Number of preprocessing processes. Default None (one per core)
+        queue_size : int, optional
+            Most files waiting between stages. Default 32
+        chunk_size : int, optional
+            Number of files whose windows are CNN classified together. Default 16
+        cnn_batch_size : int, optional
+            Number of windows per CNN batch. Default 256
+        savedir : str or None, optional
+            If given, save the plots of FileFilter.assess_file to this directory. Default None
+        kwargs
+            Passed to the threshold method, as for FileFilter.assess_file
+        """
+        self.threshold_method = threshold_method
+        self.threshold_kwargs = kwargs
+        self.category_model = category_model
+        self.denoising_model = denoising_model
+        self.minkowski_model = minkowski_model
+        self.assess_euler = assess_euler
+        self.adaptive_cnn = adaptive_cnn
+        self.cnn_window_budget = cnn_window_budget
+        self.runtime = runtime
+        self.calibration_generator = calibration_generator
+        self.denoiser_calibration_generator = denoiser_calibration_generator
+        self.defer_cnn = bool(category_model) and not adaptive_cnn
+
+        self.num_loaders = num_loaders
+        self.num_preprocessors = num_preprocessors
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.cnn_batch_size = cnn_batch_size
+        self.savedir = savedir
+
+    def run(self, filepaths):
+        """
+        Screen files
+
+        Parameters
+        ----------
+        filepaths : list of str
+            Paths of .ibw or .png files
+
+        Yields
+        ------
+        i : int
+            Index of the file in filepaths
+        filepath : str
+        filterer : FileFilter
+            The file's assessed FileFilter
+        """
+        file_queue = queue.Queue()
+        for i, filepath in enumerate(filepaths):
+            file_queue.put((i, filepath))
+        for _ in range(self.num_loaders):
+            file_queue.put(_END)
+
+        loaded_queue = queue.Queue(maxsize=self.queue_size)
+        preprocessed_queue = queue.Queue(maxsize=self.queue_size)
+        stop_event = threading.Event()
+
+        # A crashed process breaks the whole pool, so _submit adds a new one to this list
+        self._executors = [self._new_executor()]
+        self._executor_lock = threading.Lock()
+        threads = [threading.Thread(target=self._load_stage, args=(file_queue, loaded_queue, stop_event), daemon=True)
+                   for _ in range(self.num_loaders)]
+        threads.append(threading.Thread(target=self._preprocess_stage,
+                                        args=(loaded_queue, preprocessed_queue, stop_event), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            yield from self._classify_stage(preprocessed_queue)
+        finally:
+            # If screening stopped early, free the threads blocked on full queues before shutting the processes down
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            while not preprocessed_queue.empty():
+                item = preprocessed_queue.get()
+                if item is not _END:
+                    item[-1].cancel()
+            for executor in self._executors:
+                executor.shutdown()
+
+    def _new_executor(self):
+        # Preprocessing processes are spawned, as TensorFlow can hang in forked processes
+        return ProcessPoolExecutor(self.num_preprocessors, mp_context=multiprocessing.get_context("spawn"))
+
+    def _load_stage(self, file_queue, loaded_queue, stop_event):
+        try:
+            igor_translator = scope.io.translators.IgorIBWTranslator(max_mem_mb=1024)
+            for i, filepath in iter(file_queue.get, _END):
+                filterer = FileFilter(adaptive_cnn=self.adaptive_cnn, cnn_window_budget=self.cnn_window_budget,
+                                      defer_cnn=self.defer_cnn, runtime=self.runtime,
+                                      calibration_generator=self.calibration_generator,
+                                      denoiser_calibration_generator=self.denoiser_calibration_generator,
+                                      igor_translator=igor_translator)
+                try:
+                    data, _, filterer.binarized_data = filterer.load(filepath)
+                except:
+                    filterer._add_fail_reason("Unexpected error")
+                    data = None
+
+                if not _put(loaded_queue, (i, filepath, filterer, data), stop_event):
+                    return
+        finally:
+            _put(loaded_queue, _END, stop_event)
+
+    def _preprocess_stage(self, loaded_queue, preprocessed_queue, stop_event):
+        try:
+            num_loaders_running = self.num_loaders
+            while num_loaders_running:
+                item = _get(loaded_queue, stop_event)
+                if stop_event.is_set():
+                    return
+                if item is _END:
+                    num_loaders_running -= 1
+                    continue
+
+                i, filepath, filterer, data = item
+                if data is not None and not filterer.fail_reasons:
+                    future = self._submit(filterer, data)
+                else:
+                    future = Future()
+                    future.set_result((filterer, (data, None, None)))
+
+                # Futures are queued in order, so at most queue_size files are being preprocessed or waiting
+                if not _put(preprocessed_queue, (i, filepath, filterer, data, future), stop_event):
+                    return
+        finally:
+            _put(preprocessed_queue, _END, stop_event)
+
+    def _submit(self, filterer, data):
+        """Preprocess a file in the newest pool, replacing the pool if a crashed process has broken it"""
+        for _ in range(2):
+            with self._executor_lock:
+                executor = self._executors[-1]
+                try:
+                    return executor.submit(_preprocess_file, filterer, data, self.threshold_method,
+                                           self.threshold_kwargs, self.savedir is not None)
+                except BrokenProcessPool as error:
+                    self._executors.append(self._new_executor())
+                    submit_error = error
+                except Exception as error:
+                    submit_error = error
+                    break
+
+        future = Future()
+        future.set_exception(submit_error)
+        return future
+
+    def _classify_stage(self, preprocessed_queue):
+        chunk = []
+        for i, filepath, filterer, data, future in iter(preprocessed_queue.get, _END):
+            try:
+                try:
+                    preprocessed_filterer, plot_arrs = future.result()
+                except BrokenProcessPool:
+                    # Every file in the pool fails when one process crashes, so each gets a second try in a new pool
+                    preprocessed_filterer, plot_arrs = self._submit(filterer, data).result()
+                # The copy sent to the process lost its calibration data, so the results go back on the original
+                filterer._update_from_copy(preprocessed_filterer)
+            except:
+                # The preprocessing process raised or crashed, so the filterer is as it was sent
+                filterer._add_fail_reason("Unexpected error")
+                filterer.binarized_data = None
+                plot_arrs = (None, None, None)
+
+            denoised_arr = None
+            if filterer.binarized_data is not None:
+                try:
+                    _, denoised_arr = filterer.classify(filterer.binarized_data, self.denoising_model,
+                                                        self.category_model, self.assess_euler, self.minkowski_model)
+                except:
+                    filterer._add_fail_reason("Unexpected error")
+                    filterer.is_awaiting_cnn = False
+
+            chunk.append((i, filepath, filterer, plot_arrs + (denoised_arr,)))
+            if len(chunk) == self.chunk_size:
+                yield from self._finish_chunk(chunk)
+                chunk = []
+
+        yield from self._finish_chunk(chunk)
+
+    def _finish_chunk(self, chunk):
+        """CNN classify the windows of every file in the chunk together, then plot each file"""
+        cnn_classify_deferred([filterer for _, _, filterer, _ in chunk], batch_size=self.cnn_batch_size)
+
+        for i, filepath, filterer, (data, median_data, flattened_data, denoised_arr) in chunk:
+            if self.savedir:
+                try:
+                    filterer._plot(data, median_data, flattened_data, filterer.binarized_data, None, self.savedir)
+                    if denoised_arr is not None:
+                        filterer._plot_denoising(filterer.binarized_data, denoised_arr, self.savedir)
+                except:
+                    filterer._add_fail_reason("Unexpected error")
+                plt.close("all")
+
+            yield i, filepath, filterer
+
+
+def _put(bounded_queue, item, stop_event):
+    """Put an item on a bounded queue, giving up if the pipeline stops. Returns whether the item was put"""
+    while not stop_event.is_set():
+        try:
+            bounded_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(bounded_queue, stop_event):
+    """Get an item from a queue, giving up (returning None) if the pipeline stops"""
+    while not stop_event.is_set():
+        try:
+            return bounded_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+
+def _preprocess_file(filterer, data, threshold_method, threshold_kwargs, keep_plot_arrs):
+    """Preprocess a loaded file in a worker process, returning the filterer and the arrays needed for plotting"""
+    median_data = flattened_data = None
+    try:
+        _, median_data, flattened_data, filterer.binarized_data = filterer.preprocess(data, threshold_method,
+                                                                                      **threshold_kwargs)
+    except:
+        filterer._add_fail_reason("Unexpected error")
+
+    if not keep_plot_arrs:
+        data = median_data = flattened_data = None
+    return filterer, (data, median_data, flattened_data)
@@ -0,0 +1,114 @@
+import json
+import time
+from collections import deque
+
+import numpy as np
+from tensorflow.python.keras.callbacks import Callback
+
+
+class ThroughputLogger(Callback):
+    def __init__(self, log_path, generator=None, batch_size=None):
+        """
+        Log where the time in each training batch goes, as JSON lines, to find what is holding training back
+
+        Every batch is split into the time the model waited for data (data_wait) and the time spent in the model
+        (train_step), along with samples/s. data_wait comes from the "ready" time the generator records in
+        batch_timings (h5RabaniDataGenerator, SimulatedRabaniDataGenerator, SharedMemoryPrefetcher): batches are
+        used in the order they are made, so it is how long after the start of each step its batch was ready. It is
+        an estimate when keras makes batches with more than one worker, and isn't logged without a generator (e.g.
+        for a tf.data.Dataset). The mean load/augment/binarise times of batches made since the last log are added,
+        and queue_wait/queue_depth from a SharedMemoryPrefetcher.
+        A summary line is written at the end of each epoch, and a SharedMemoryPrefetcher's stats at the end of training
+
+        Parameters
+        ----------
+        log_path : str
+            JSON lines file to append to, e.g. next to the model checkpoint
+        generator : Sequence or None, optional
+            The training generator. Default None (only train_step and samples/s are logged)
+        batch_size : int or None, optional
+            Samples per batch. Default None (generator.batch_size)
+        """
+        super().__init__()
+        self.log_path = log_path
+        self.generator = generator
+        self.batch_size = batch_size or getattr(generator, "batch_size", None)
+        if self.batch_size is None and hasattr(generator, "generator"):
+            self.batch_size = generator.generator.batch_size
+
+        self._log_file = None
+        self._epoch = 0
+        self._last_batch_end = None
+        self._batch_start = None
+        self._epoch_records = []
+        self._ready_times = deque()
+
+    def on_train_begin(self, logs=None):
+        self._log_file = open(self.log_path, "a")
+        self._last_batch_end = time.perf_counter()
+        # keras fetches a batch to find the data's shapes before training
+        self._ready_times.clear()
+        if getattr(self.generator, "batch_timings", None):
+            self.generator.batch_timings.clear()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch = epoch
+        self._epoch_records = []
+        self._last_batch_end = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._batch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        batch_end = time.perf_counter()
+        record = {"type": "batch", "epoch": self._epoch, "batch": batch, "train_step": batch_end - self._batch_start}
+        record.update(self._drain_generator_timings())
+
+        if self._ready_times:
+            # The batch used in this step is the oldest not yet used
+            data_wait = min(max(self._ready_times.popleft() - self._batch_start, 0.), record["train_step"])
+            record["data_wait"] = data_wait
+            record["train_step"] -= data_wait
+        if self.batch_size:
+            record["samples_per_s"] = self.batch_size / (batch_end - self._last_batch_end)
+
+        self._epoch_records.append(record)
+        self._write(record)
+        self._last_batch_end = batch_end
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self._epoch_records:
+            return
+
+        summary = {"type": "epoch", "epoch": epoch, "batches": len(self._epoch_records)}
+        for key in self._epoch_records[0]:
+            if key not in ["type", "epoch", "batch"]:
+                summary[key] = float(np.mean([record[key] for record in self._epoch_records if key in record]))
+        self._write(summary)
+
+    def on_train_end(self, logs=None):
+        if self._log_file is not None and hasattr(self.generator, "stats"):
+            self._write(dict({"type": "prefetch"}, **self.generator.stats()))
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def _drain_generator_timings(self):
+        """Mean of each timing the generator recorded since the last batch, keeping when each batch was ready"""
+        batch_timings = getattr(self.generator, "batch_timings", None)
+        if not batch_timings:
+            return {}
+
+        drained = []
+        while batch_timings:
+            timings = dict(batch_timings.popleft())
+            if "ready" in timings:
+                self._ready_times.append(timings.pop("ready"))
+            drained.append(timings)
+
+        return {key: float(np.mean([timings[key] for timings in drained if key in timings])) for key in drained[0]}
+
+    def _write(self, record):
+        self._log_file.write(json.dumps(record) + "\n")
+        self._log_file.flush()
+
@@ -1,5 +1,6 @@
 import os
-import subprocess
+import time
+from collections import deque
 
 import h5py
 import numpy as np
@@ -7,13 +8,16 @@ from scipy.stats import bernoulli
 from sklearn.utils import class_weight
 from tensorflow.python.keras.utils import Sequence
 
-from Models.utils import resize_image, remove_least_common_level, normalise
+from Models.utils import resize_images, binarise_batch
+
+CATEGORY_INDEX_FILENAME = "category_index.npz"
 
 
 class h5RabaniDataGenerator(Sequence):
     def __init__(self, simulated_image_dir, network_type, batch_size, output_parameters_list, output_categories_list,
                  is_train, imsize=None, horizontal_flip=True, vertical_flip=True, x_noise=0.005, circshift=True,
-                 randomise_levels=False, force_binarisation=True):
+                 randomise_levels=False, force_binarisation=True, storage_dtype=np.uint8, output_dtype=np.float32,
+                 seed=None, rank=0, world_size=1, sampler="sequential", rescan=False):
         """
         A keras data generator class for rabani simulations stored as h5 files in a directory
 
@@ -44,7 +48,31 @@ class h5RabaniDataGenerator(Sequence):
             Categories to be predicted by the network if network_structure == "classifier"
         force_binarisation : bool
             If we should force the image to be binarised or not
+        storage_dtype : dtype, optional
+            Dtype of the batch and validation buffers while loading and augmenting. Default np.uint8
+        output_dtype : dtype, optional
+            Dtype batches are cast to when handed to the model. Default np.float32.
+            Use tensorflow.bfloat16.as_numpy_dtype for bfloat16
+        seed : int or None, optional
+            Seed for the epoch permutations and augmentations. Each sample is augmented with its own generator,
+            seeded from (seed, epoch, file index), so a run can be replayed whatever the batching or sharding.
+            Default None (a random seed, stored in self.seed). Must be given if world_size > 1, so every rank permutes
+            the files the same way
+        rank : int, optional
+            Index of this process amongst those splitting the dataset. Default 0
+        world_size : int, optional
+            Number of processes splitting the dataset. Each gets a disjoint shard of equal size. Default 1
+        sampler : str, optional
+            "sequential" (default) to run through the (permuted) shard, or "stratified" to build every batch with
+            equal numbers of each category, oversampling rarer categories. Categories come from a cached index
+            (see load_category_index), and class weights are not needed
+        rescan : bool, optional
+            Look for newly finished simulations whenever the epoch changes, so training can start while
+            RabaniSweeper is still running. Default False. Keras fixes class_weight when fit starts, so classifier
+            batches (with the sequential sampler) instead come as (x, y, sample_weight), weighted by the class
+            weights of the files found by the latest scan. Don't also pass class_weight to fit
         """
+        super().__init__()
 
         self.root_dir = simulated_image_dir
         self.batch_size = batch_size
@@ -62,9 +90,24 @@ class h5RabaniDataGenerator(Sequence):
         self.circshift = circshift
         self.randomise_levels = randomise_levels
         self.force_binarisation = force_binarisation
+        self.storage_dtype = storage_dtype
+        self.output_dtype = output_dtype
+
+        assert 0 <= rank < world_size
+        if world_size > 1 and seed is None:
+            raise ValueError("seed must be given when world_size > 1, so the ranks' shards don't overlap")
+        assert sampler in ["sequential", "stratified"]
+        self.sampler = sampler
+        self.rescan = rescan
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
 
         self.class_weights_dict = None
-        self.__reset_file_iterator__()
+        self._list_files()
+        self._index_categories()
+        self._shuffle_and_shard()
 
         if imsize:
             self.image_res = imsize
@@ -73,150 +116,245 @@ class h5RabaniDataGenerator(Sequence):
 
         self._get_class_weights()
 
-        self._batches_counter = 0
-        self.x_true = np.zeros((self.__len__() * self.batch_size, self.image_res, self.image_res, 1))
-        self.y_true = np.zeros((self.__len__() * self.batch_size, len(self.original_categories_list)))
+        self.x_true = self.y_true = None
 
-    def _get_class_weights(self):
-        """Open all the files once to compute the class weights"""
-        self.__reset_file_iterator__()
-        if self.is_training_set:
-            # os.scandir random iterates, so can take a subset of max 50k files to make good approximation
-            length = min(int(self.__len__()) * self.batch_size, 50000)
-        else:
-            length = int(self.__len__()) * self.batch_size
+        # Time spent loading, augmenting and binarising each batch, for Models.callbacks.ThroughputLogger
+        self.batch_timings = deque(maxlen=1000)
 
-        if not self.is_validation_set:
-            class_inds = np.zeros((length,))
+    def _index_categories(self):
+        """Category index of every file, from the cached index rather than opening each file"""
+        categories = load_category_index(self.root_dir, self._file_list)
+        category_lookup = {category: i for i, category in enumerate(self.original_categories_list)}
+        self._category_inds = np.array([category_lookup[category] for category in categories], dtype=int)
 
-            for i in range(length):
-                file_entry = self._file_iterator.__next__().path
-                h5_file = h5py.File(file_entry, "r")
-                idx_find = self.original_categories_list.index(h5_file.attrs["category"])
-                class_inds[i] = idx_find
+    def _get_class_weights(self):
+        """Compute the class weights from the category index"""
+        if self.sampler == "stratified":
+            # Batches are already balanced
+            return
 
+        if not self.is_validation_set:
             self.class_weights_dict = class_weight.compute_class_weight('balanced',
                                                                         np.arange(len(self.original_categories_list)),
-                                                                        class_inds)
-        self.__reset_file_iterator__()
+                                                                        self._category_inds[self._shard_inds])
 
     def _get_image_res(self):
         """Open one file to check the image resolution"""
-        self.image_res = len(h5py.File(self._file_iterator.__next__().path, "r")["sim_results"]["image"])
-        self.__reset_file_iterator__()
+        self.image_res = len(h5py.File(self._file_list[0], "r")["sim_results"]["image"])
 
     def on_epoch_end(self):
         """At end of epoch"""
-        self.__reset_file_iterator__()
+        self.set_epoch(self.epoch + 1)
+
+    def set_epoch(self, epoch):
+        """Move to the file order and augmentations of a given epoch"""
+        is_rescanning = self.rescan and epoch != self.epoch
+        if is_rescanning:
+            self._list_files()
+            self._index_categories()
+
+        self.epoch = epoch
+        self._shuffle_and_shard()
+
+        if is_rescanning:
+            self._get_class_weights()
+
+    def _list_files(self):
+        """
+        List the h5 files once (os.scandir rather than os.listdir for speed on massive datasets!), so that batch idx
+        can be read in any order, by any process. Sorted, as scandir order differs between filesystems.
+        Files still being written by RabaniSweeper end in .tmp, so are skipped
+        """
+        self._file_list = sorted(file_entry.path for file_entry in os.scandir(self.root_dir)
+                                 if file_entry.name.endswith(".h5"))
+
+    def _shuffle_and_shard(self):
+        """Permute the files for this epoch (training only), then take this rank's shard"""
+        num_files = len(self._file_list)
+        if self.is_training_set:
+            file_inds = np.random.default_rng([self.seed, self.epoch]).permutation(num_files)
+        else:
+            file_inds = np.arange(num_files)
 
-    def __reset_file_iterator__(self):
-        """Resets the file iterator (do this instead of os.listdir for speed on massive datasets!)"""
-        self._file_iterator = os.scandir(self.root_dir)
-        self._batches_counter = 0
+        # Every rank gets the same number of files, so they stay in step
+        self._shard_inds = file_inds[self.rank::self.world_size][:num_files // self.world_size]
+
+        if self.sampler == "stratified":
+            self._shard_inds = self._stratify(self._shard_inds)
+
+    def _stratify(self, file_inds):
+        """
+        Reorder file_inds so every batch has (as near as possible) equal numbers of each category present.
+        Rarer categories are cycled through more than once per epoch, with a fresh permutation each time
+        """
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
+        num_batches = len(file_inds) // self.batch_size
+
+        shard_categories = self._category_inds[file_inds]
+        category_file_inds = [file_inds[shard_categories == i] for i in np.unique(shard_categories)]
+        num_cats = len(category_file_inds)
+
+        # Spread the remainder of batch_size / num_cats across the categories, batch by batch
+        per_batch = np.full((num_batches, num_cats), self.batch_size // num_cats)
+        remainder = self.batch_size % num_cats
+        extra_cats = (np.arange(num_batches)[:, np.newaxis] * remainder + np.arange(remainder)) % num_cats
+        np.add.at(per_batch, (np.arange(num_batches)[:, np.newaxis], extra_cats), 1)
+
+        category_streams = []
+        for inds, num_needed in zip(category_file_inds, per_batch.sum(axis=0)):
+            num_cycles = -(-num_needed // len(inds))
+            category_streams.append(np.concatenate([rng.permutation(inds) for _ in range(num_cycles)]))
+
+        # Batch b takes the next per_batch[b, c] files of each category c
+        starts = np.vstack([np.zeros((1, num_cats), dtype=int), np.cumsum(per_batch, axis=0)])
+        stratified_inds = np.empty(num_batches * self.batch_size, dtype=int)
+        for b in range(num_batches):
+            batch = np.concatenate([stream[starts[b, c]:starts[b + 1, c]]
+                                    for c, stream in enumerate(category_streams)])
+            stratified_inds[b * self.batch_size:(b + 1) * self.batch_size] = rng.permutation(batch)
+
+        return stratified_inds
+
+    def _sample_rngs(self, file_inds):
+        """One generator per sample, seeded from (seed, epoch, file index)"""
+        return [np.random.default_rng([self.seed, self.epoch, file_ind]) for file_ind in file_inds]
 
     def __len__(self):
-        n_files = int(
-            subprocess.Popen([f"find '{self.root_dir}' -maxdepth 1 | wc -l"],
-                             stderr=subprocess.PIPE, stdout=subprocess.PIPE, shell=True).communicate()[0]) - 1
-        return int(np.floor(n_files // self.batch_size))
+        return int(np.floor(len(self._shard_inds) // self.batch_size))
+
+    def _allocate_validation_buffers(self):
+        """Validation truth is only stored once is_validation_set has been switched on"""
+        self.x_true = np.zeros((self.__len__() * self.batch_size, self.image_res, self.image_res, 1),
+                               dtype=self.storage_dtype)
+        self.y_true = np.zeros((self.__len__() * self.batch_size, len(self.original_categories_list)), dtype=np.uint8)
 
     def __getitem__(self, idx):
         """Get self.batch_size number of items, shaped and augmented"""
+        start_time = time.perf_counter()
 
         # Preallocate output
-        batch_x = np.empty((self.batch_size, self.image_res, self.image_res, 1))
-        batch_y = np.zeros((self.batch_size, len(self.original_categories_list)))
+        batch_x = np.empty((self.batch_size, self.image_res, self.image_res, 1), dtype=self.storage_dtype)
+        batch_y = np.zeros((self.batch_size, len(self.original_categories_list)), dtype=self.output_dtype)
+
+        if self.is_validation_set and self.x_true is None:
+            self._allocate_validation_buffers()
+
+        file_inds = self._shard_inds[idx * self.batch_size:(idx + 1) * self.batch_size]
+        rngs = self._sample_rngs(file_inds)
 
         # For each file in the batch
-        for i in range(self.batch_size):
+        imgs = []
+        for i, file_ind in enumerate(file_inds):
             # Parse parameters from the h5 file
-            file_entry = self._file_iterator.__next__().path
-            h5_file = h5py.File(file_entry, "r")
+            h5_file = h5py.File(self._file_list[file_ind], "r")
 
-            batch_x[i, :, :, 0] = resize_image(h5_file["sim_results"]["image"][()], self.image_res).astype(np.uint8)
+            imgs.append(h5_file["sim_results"]["image"][()])
+            batch_y[i, self._category_inds[file_ind]] = 1
 
-            idx_find = self.original_categories_list.index(h5_file.attrs["category"])
-            batch_y[i, idx_find] = 1
+        # Resize every image sharing a size with one gather
+        batch_x[:, :, :, 0] = resize_images(imgs, self.image_res)
 
-            if self.is_validation_set:
-                self.x_true[self._batches_counter * self.batch_size:(self._batches_counter + 1) * self.batch_size,
-                :, :, :] = batch_x
-                self.y_true[self._batches_counter * self.batch_size:(self._batches_counter + 1) * self.batch_size,
-                :] = batch_y
+        if self.is_validation_set:
+            self.x_true[idx * self.batch_size:(idx + 1) * self.batch_size, :, :, :] = batch_x
+            self.y_true[idx * self.batch_size:(idx + 1) * self.batch_size, :] = batch_y
+        load_time = time.perf_counter()
 
         if self.is_training_set:
-            batch_x = self._augment(batch_x)
+            batch_x = self._augment(batch_x, rngs)
+        augment_time = time.perf_counter()
 
         if self.force_binarisation:
-            batch_x = self._patch_binarisation(batch_x)
+            batch_x = self._patch_binarisation(batch_x, rngs)
 
-        self._batches_counter += 1
-        if self._batches_counter >= self.__len__() and self.is_training_set is False:
-            self.__reset_file_iterator__()
+        ready_time = time.perf_counter()
+        self.batch_timings.append({"load": load_time - start_time, "augment": augment_time - load_time,
+                                   "binarise": ready_time - augment_time, "ready": ready_time})
 
         if self.network_type is "classifier":
-            if self.is_validation_set:
-                self.y_true[self._batches_counter * self.batch_size:(self._batches_counter + 1) * self.batch_size,
-                :] = batch_y
-
-            return batch_x, batch_y
+            if self.rescan and self.class_weights_dict is not None:
+                sample_weight = np.asarray(self.class_weights_dict, dtype=self.output_dtype)[
+                    self._category_inds[file_inds]]
+                return batch_x.astype(self.output_dtype, copy=False), batch_y, sample_weight
+            return batch_x.astype(self.output_dtype, copy=False), batch_y
         elif self.network_type is "autoencoder":
-            noisy_x = self.speckle_noise(batch_x, perc_noise=0.4, perc_std=0.005)
+            noisy_x = self.speckle_noise(batch_x, perc_noise=0.4, perc_std=0.005, rngs=rngs)
 
             if self.is_validation_set:
                 self.x_true = self._patch_binarisation(self.x_true)
-            return noisy_x, batch_x
+            return noisy_x.astype(self.output_dtype, copy=False), batch_x.astype(self.output_dtype, copy=False)
         else:
             pass
 
-    def _augment(self, batch_x):
+    def _augment(self, batch_x, rngs=None):
         if self.vflip:
-            batch_x = self.flip(batch_x, axis=1)
+            batch_x = self.flip(batch_x, axis=1, rngs=rngs)
         if self.hflip:
-            batch_x = self.flip(batch_x, axis=2)
+            batch_x = self.flip(batch_x, axis=2, rngs=rngs)
         if self.circshift:
-            batch_x = self.circ_shift(batch_x)
+            batch_x = self.circ_shift(batch_x, rngs=rngs)
         if self.randomise_levels:
-            batch_x = self.randomise_level_index(batch_x)
+            batch_x = self.randomise_level_index(batch_x, rngs=rngs)
         if self.xnoise:
-            batch_x = self.speckle_noise(batch_x, perc_noise=self.xnoise, perc_std=0.002)
+            batch_x = self.speckle_noise(batch_x, perc_noise=self.xnoise, perc_std=0.002, rngs=rngs)
 
         return batch_x
 
-    def flip(self, batch_x, axis):
-        augment_inds_vflip = np.random.choice(self.batch_size, size=(self.batch_size,), replace=False)
-        batch_x[augment_inds_vflip, :, :, 0] = np.flip(batch_x[augment_inds_vflip, :, :, 0], axis=axis)
+    @staticmethod
+    def flip(batch_x, axis, rngs=None):
+        if rngs is None:
+            is_flipped = np.random.random_sample(len(batch_x)) < 0.5
+        else:
+            is_flipped = np.array([rng.random() < 0.5 for rng in rngs], dtype=bool)
+        batch_x[is_flipped, :, :, 0] = np.flip(batch_x[is_flipped, :, :, 0], axis=axis)
 
         return batch_x
 
-    def circ_shift(self, batch_x):
-        rand_shifts = np.random.choice(self.image_res, size=(self.batch_size, 2))
+    @staticmethod
+    def circ_shift(batch_x, rngs=None):
+        if rngs is None:
+            rand_shifts = np.random.choice(batch_x.shape[1], size=(len(batch_x), 2))
+        else:
+            rand_shifts = [rng.integers(0, batch_x.shape[1], size=2) for rng in rngs]
         for i, rand_shift in enumerate(rand_shifts):
             batch_x[i, :, :, 0] = np.roll(batch_x[i, :, :, 0], shift=rand_shift, axis=[0, 1])
 
         return batch_x
 
     @staticmethod
-    def randomise_level_index(batch_x):
+    def randomise_level_index(batch_x, rngs=None):
         tmp_x = batch_x.copy()
-        for i, idx in enumerate(np.random.choice(np.unique(batch_x), len(np.unique(batch_x)), replace=False)):
-            tmp_x[batch_x == idx] = i
+        levels = np.unique(batch_x)
+        if rngs is None:
+            for i, idx in enumerate(np.random.choice(levels, len(levels), replace=False)):
+                tmp_x[batch_x == idx] = i
+        else:
+            # Each image gets its own swap of levels
+            for j, rng in enumerate(rngs):
+                for i, idx in enumerate(rng.permutation(levels)):
+                    tmp_x[j][batch_x[j] == idx] = i
 
         return tmp_x
 
     @staticmethod
-    def speckle_noise(batch_x, perc_noise, perc_std, randomness="elementwise", num_uniques=None, scaling=True):
-        if randomness == "elementwise":
+    def speckle_noise(batch_x, perc_noise, perc_std, randomness="elementwise", num_uniques=None, scaling=True,
+                      rngs=None):
+        if rngs is not None:
+            # Per-sample generators, so each image's noise is independent of the rest of the batch
+            if randomness not in ["elementwise", "batchwise"]:
+                raise ValueError("randomness must be one of ['elementwise', batchwise]")
+            rand_mask = np.zeros(batch_x.shape, dtype=bool)
+            for i, rng in enumerate(rngs):
+                p = np.abs(rng.normal(loc=perc_noise, scale=perc_std)) if randomness == "elementwise" else perc_noise
+                rand_mask[i] = rng.random(batch_x[i].shape) <= p
+        elif randomness == "elementwise":
             assert batch_x.ndim == 4
             p_all = np.abs(np.random.normal(loc=perc_noise, scale=perc_std, size=(len(batch_x),)))
-            rand_mask = np.zeros(batch_x.shape)
+            rand_mask = np.zeros(batch_x.shape, dtype=bool)
             for i, p in enumerate(p_all):
                 rand_mask[i, :, :, 0] = bernoulli.rvs(p=p, size=batch_x[0, :, :, 0].shape)
         elif randomness == "batchwise":
             # rand_mask = bernoulli.rvs(p=np.abs(np.random.normal(loc=perc_noise, scale=perc_std)), size=batch_x.shape)
-            rand_mask = np.zeros(batch_x.shape)
-            rand_vals = np.random.rand(*batch_x.shape)
-            rand_mask[rand_vals <= perc_noise] = 1
+            rand_mask = np.random.random_sample(batch_x.shape) <= perc_noise
         else:
             raise ValueError("randomness must be one of ['elementwise', batchwise]")
 
@@ -224,21 +362,71 @@ class h5RabaniDataGenerator(Sequence):
             num_uniques = len(np.unique(batch_x))
 
         if num_uniques > 1:     # Ignore if array is single-valued
-            rand_arr = np.random.randint(0, num_uniques - 1, size=batch_x.shape)
+            if rngs is None:
+                rand_arr = np.random.randint(0, num_uniques - 1, size=np.count_nonzero(rand_mask), dtype=np.uint8)
+            else:
+                # Masked pixels are taken image by image, so each image's values come from its own generator
+                num_masked = np.count_nonzero(rand_mask.reshape(len(batch_x), -1), axis=1)
+                rand_arr = np.concatenate([rng.integers(0, num_uniques - 1, size=n, dtype=np.uint8)
+                                           for rng, n in zip(rngs, num_masked)])
             if scaling:
                 rand_arr *= (num_uniques - 1)
 
-            batch_x[rand_mask == 1] = rand_arr[rand_mask == 1]
+            batch_x[rand_mask] = rand_arr
 
         return batch_x
 
     @staticmethod
-    def _patch_binarisation(batch_x):
+    def _patch_binarisation(batch_x, rngs=None):
         """
         Finds the least common level in each image in the batch, and replaces it randomly by the other levels
         """
-        for i in range(len(batch_x)):
-            batch_x[i, :, :, 0] = remove_least_common_level(batch_x[i, :, :, 0])
-            batch_x[i, :, :, 0] = normalise(batch_x[i, :, :, 0])
-
-        return batch_x
\ No newline at end of file
+        return binarise_batch(batch_x, rngs=rngs)
+
+
+def load_category_index(simulated_image_dir, file_paths=None):
+    """
+    Category of every simulation in a directory, cached in CATEGORY_INDEX_FILENAME so each file is only ever opened
+    once. Files not yet in the cache are read and added to it. Simulations are never rewritten, so cached entries
+    are trusted
+
+    Parameters
+    ----------
+    simulated_image_dir : str
+        Directory of simulated h5 files
+    file_paths : list of str or None, optional
+        Files to get categories for. Default None (every h5 file in the directory, sorted)
+
+    Returns
+    -------
+    categories : ndarray
+        Category string of each file in file_paths
+    """
+    if file_paths is None:
+        file_paths = sorted(file_entry.path for file_entry in os.scandir(simulated_image_dir)
+                            if file_entry.name.endswith(".h5"))
+    index_path = os.path.join(simulated_image_dir, CATEGORY_INDEX_FILENAME)
+
+    cached = {}
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            cached = dict(zip(index["files"], index["categories"]))
+
+    file_names = [os.path.basename(file_path) for file_path in file_paths]
+    is_missing = [file_name not in cached for file_name in file_names]
+    for file_path, file_name, missing in zip(file_paths, file_names, is_missing):
+        if missing:
+            with h5py.File(file_path, "r") as h5_file:
+                cached[file_name] = h5_file.attrs["category"]
+
+    if any(is_missing):
+        # Write then rename, so a reader never sees a half-written index
+        try:
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, files=np.array(list(cached.keys())), categories=np.array(list(cached.values())))
+            os.replace(tmp_path, index_path)
+        except OSError:
+            pass    # Read-only dataset, so just don't cache
+
+    return np.array([cached[file_name] for file_name in file_names])
@@ -58,6 +58,73 @@ def _VGG(input_shape, output_num, optimiser):
     return model
 
 
+def make_fully_convolutional(model, head_stride=1):
+    """
+    Convert a trained Dense-head classifier (e.g. _VGG or _orig_model) into an equivalent fully convolutional model
+
+    The first Dense layer after Flatten becomes a Conv2D with a kernel the size of the flattened feature map, and
+    every later Dense layer a 1x1 Conv2D, with the Dense weights reshaped across. A single forward pass over an image
+    larger than the original input then gives the prediction of every window, on a grid with a spacing of
+    get_output_stride(model) * head_stride pixels
+
+    Parameters
+    ----------
+    model : tensorflow.keras.Model
+        Trained Sequential classifier of Conv2D, MaxPooling2D, Dropout, Flatten and Dense layers
+    head_stride : int, optional
+        Stride of the converted first Dense layer, so only every head_stride-th window is computed. Default 1
+
+    Returns
+    -------
+    fcn_model : tensorflow.keras.Model
+        Model taking images of any size (at least the original input size), giving (N x H' x W' x output_num)
+    """
+    fcn_model = Sequential()
+    fcn_model.add(Input(shape=(None, None, model.input_shape[-1])))
+
+    weights = []
+    flattened_shape = None
+    for layer in model.layers:
+        if isinstance(layer, Flatten):
+            flattened_shape = tuple(layer.input.shape[1:])
+            continue
+
+        config = layer.get_config()
+        config.pop("batch_input_shape", None)
+        config.pop("batch_shape", None)
+
+        if isinstance(layer, Dense):
+            kernel, bias = layer.get_weights()
+            if flattened_shape is not None:
+                kernel_size = flattened_shape[:2]
+                strides = head_stride
+                flattened_shape = None
+            else:
+                kernel_size = (1, 1)
+                strides = 1
+
+            fcn_model.add(Conv2D(config["units"], kernel_size, strides=strides, activation=config["activation"],
+                                 name=config["name"]))
+            weights += [kernel.reshape(kernel_size + (-1, config["units"])), bias]
+        else:
+            fcn_model.add(layer.__class__.from_config(config))
+            weights += layer.get_weights()
+
+    fcn_model.set_weights(weights)
+
+    return fcn_model
+
+
+def get_output_stride(model):
+    """Distance (in input pixels) between neighbouring predictions of the fully convolutional version of model"""
+    output_stride = 1
+    for layer in model.layers:
+        if isinstance(layer, (Conv2D, MaxPooling2D)):
+            output_stride *= layer.strides[0]
+
+    return output_stride
+
+
 def autoencoder(input_shape, optimiser):
     input_img = Input(shape=input_shape)
 
@@ -1,14 +1,24 @@
 import itertools
 import warnings
+import weakref
 
 import numpy as np
-from tensorflow.python.keras.models import load_model
+from numpy.lib.stride_tricks import sliding_window_view
+from tensorflow.keras.layers import Input
+from tensorflow.keras.models import clone_model
 
-from Analysis.image_stats import calculate_stats, calculate_normalised_stats
+from Analysis.image_stats import categorise_windows, calculate_normalised_stats_batch, window_corners, \
+    window_euler_numbers, region_euler_numbers_batch, SlidingWindowEuler, SlidingWindowMoments, moments_batch, \
+    shape_stats_from_moments, use_zero_region
 from Analysis.model_stats import test_classifier
-from Models.h5_iterator import h5RabaniDataGenerator
+from Models.model_CNN import make_fully_convolutional, get_output_stride
+from Models.quantise import TFLiteModel, select_runtime
 from Models.train_CNN import validate_CNN
-from Models.utils import zigzag_product
+from Models.utils import zigzag_product, OverlapAddAccumulator, SpeckleNoise
+
+# Fully convolutional versions of classifiers, and any-size versions of autoencoders, converted once per model
+_fully_convolutional_models = weakref.WeakKeyDictionary()
+_any_size_models = weakref.WeakKeyDictionary()
 
 
 class ImageClassifier:
@@ -26,12 +36,23 @@ class ImageClassifier:
         A trained tensorflow model. Required for CNN classifications
     sklearn_model: object of type sklearn.classifier
         A trained sklearn classifier. Required for stats classifications
+    dense_inference: bool
+        If img is 2D, classify every window in one pass of a fully convolutional copy of cnn_model, rather than
+        one pass per window. Only used if window_stride is a multiple of the model's output stride. Default True
+    runtime: str
+        "keras" to run cnn_model as it is, or "tflite" to run a quantised TFLite copy of it (see
+        Models.quantise.select_runtime). cnn_model can also be a Models.quantise.TFLiteModel. Default "keras"
+    calibration_generator: Sequence or None
+        Classifier data to calibrate full int8 quantisation with when runtime is "tflite". Default None (only the
+        weights are quantised)
     """
 
-    def __init__(self, img, cnn_model=None, sklearn_model=None, window_stride=8):
+    def __init__(self, img, cnn_model=None, sklearn_model=None, window_stride=8, dense_inference=True,
+                 runtime="keras", calibration_generator=None):
         self.img_arr = img
+        self.dense_inference = dense_inference
 
-        self.cnn_model = cnn_model
+        self.cnn_model = select_runtime(cnn_model, runtime, calibration_generator) if cnn_model else None
         self.sklearn_model = sklearn_model
 
         if self.cnn_model:
@@ -42,32 +63,74 @@ class ImageClassifier:
 
         self.jump = window_stride
 
+        # Windows are a read-only (rows x cols x size x size) view, and only copied a batch at a time
         if img.ndim != 4:
-            self.cnn_arr = self._wrap_image_to_tensorflow(img, self.network_img_size, self.jump)
+            self._window_grid = self._window_view(img, self.network_img_size, self.jump)
         else:
-            self.cnn_arr = img
+            self._window_grid = img[np.newaxis, :, :, :, 0].view()
+            self._window_grid.flags.writeable = False
+        self.num_windows = self._window_grid.shape[0] * self._window_grid.shape[1]
 
         self.cats = ['liquid', 'hole', 'cellular', 'labyrinth', 'island']
         self.cnn_preds = self.cnn_majority_preds = None
+        self.cnn_window_inds = None
         self.euler_preds = self.euler_majority_preds = None
         self.minkowski_preds = self.minkowski_majority_preds = None
 
+        # Per-window features (Euler numbers, level counts, region shapes, Minkowski stats), computed once on first
+        # use and shared by the classifiers and FileFilter's checks
+        self.window_features = {}
+
+    @property
+    def cnn_arr(self):
+        """Every window copied into one (N x size x size x 1) array. Prefer windows() or window_batches()"""
+        return self._window_grid.reshape((-1,) + self._window_grid.shape[2:])[:, :, :, np.newaxis].astype(float)
+
+    def windows(self):
+        """Iterate over each (read-only) window, in the order of cnn_arr"""
+        for window_row in self._window_grid:
+            yield from window_row
+
+    def window_batches(self, batch_size=256, dtype=np.float32):
+        """
+        Iterate over (at most batch_size x size x size x 1) batches of windows, in the order of cnn_arr.
+        The same buffer is refilled for every batch, so memory doesn't grow with the number of windows
+        """
+        buffer = np.empty((min(batch_size, self.num_windows),) + self._window_grid.shape[2:] + (1,), dtype=dtype)
+        for start in range(0, self.num_windows, batch_size):
+            yield self._fill_window_batch(buffer, np.arange(start, min(start + batch_size, self.num_windows)))
+
+    def _fill_window_batch(self, buffer, window_inds):
+        """Copy the windows window_inds (indices into cnn_arr) into the start of buffer, returning the filled part"""
+        num_cols = self._window_grid.shape[1]
+        batch = buffer[:len(window_inds)]
+        batch[:, :, :, 0] = self._window_grid[window_inds // num_cols, window_inds % num_cols]
+        return batch
+
     @staticmethod
-    def _wrap_image_to_tensorflow(img, network_img_size, stride, zigzag=False):
-        """Subsamples an image to turn it into a tensorflow-compatible shape"""
+    def _window_view(img, network_img_size, stride):
+        """Read-only (num_jumps x num_jumps x size x size) view of the windows of img, without copying"""
         # Figure out how many "windows" to make
         num_jumps = int((len(img) - network_img_size) / stride)
+        window_view = sliding_window_view(img, (network_img_size, network_img_size))
+
+        return window_view[::stride, ::stride][:num_jumps, :num_jumps]
+
+    @staticmethod
+    def _wrap_image_to_tensorflow(img, network_img_size, stride, zigzag=False):
+        """Subsamples an image to turn it into a tensorflow-compatible shape"""
+        window_grid = ImageClassifier._window_view(img, network_img_size, stride)
+        num_jumps = len(window_grid)
 
         if zigzag:
             jump_idx = zigzag_product(np.arange(num_jumps), np.arange(num_jumps))
         else:
             jump_idx = itertools.product(np.arange(num_jumps), np.arange(num_jumps))
+        jump_idx = np.array(list(jump_idx), dtype=int).reshape(-1, 2)
 
-        # Copy each window out
+        # Copy the windows out
         cnn_arr = np.zeros((num_jumps ** 2, network_img_size, network_img_size, 1))
-        for i, (jump_i, jump_j) in enumerate(jump_idx):
-            cnn_arr[i, :, :, 0] = img[(jump_i * stride): (jump_i * stride) + network_img_size,
-                                  (jump_j * stride): (jump_j * stride) + network_img_size]
+        cnn_arr[:, :, :, 0] = window_grid[jump_idx[:, 0], jump_idx[:, 1]]
 
         return cnn_arr
 
@@ -84,57 +147,420 @@ class ImageClassifier:
         else:
             jump_idx = itertools.product(np.arange(num_jumps), np.arange(num_jumps))
 
-        # Spread all wrapped images over new size
-        big_arr = np.zeros((len(imgs), output_img_size, output_img_size))
-        big_arr[:] = np.nan
-        for i, (jump_i, jump_j) in enumerate(jump_idx):
-            big_arr[i,
-            (jump_i * stride): (jump_i * stride) + network_img_size,
-            (jump_j * stride): (jump_j * stride) + network_img_size] = imgs[i, :, :, 0]
+        # Vote all wrapped images into new size
+        accumulator = OverlapAddAccumulator((output_img_size, output_img_size))
+        accumulator.add_batch([(jump_i * stride, jump_j * stride) for jump_i, jump_j in jump_idx], imgs[:, :, :, 0])
 
-        voted_arr = np.nanmean(big_arr, axis=0).round()
+        voted_arr = accumulator.result().round()
 
         return voted_arr
 
-    def cnn_classify(self, perc_noise=0.05, perc_std=0.001):
-        noisy_array = h5RabaniDataGenerator.speckle_noise(self.cnn_arr.copy(), perc_noise, perc_std,
-                                                          randomness="batchwise",
-                                                          num_uniques=len(np.unique(self.cnn_arr[0, :, :, 0])))
+    def reconstruct(self, window_func, batch_size=256):
+        """
+        Apply window_func (e.g. a denoiser's predict) to every window a batch at a time, voting each batch of outputs
+        straight into a full-size image, so no more than one batch of windows exists at once
+
+        Parameters
+        ----------
+        window_func : callable
+            Takes a (N x size x size x 1) batch of windows, returning (N x size x size x 1) outputs
+        batch_size : int, optional
+            Number of windows per batch. Default 256
+
+        Returns
+        -------
+        voted_arr : ndarray
+            Mean output at each pixel of the original image, or NaN for pixels no window covers
+        """
+        if self.img_arr.ndim != 2:
+            raise ValueError("Can only reconstruct when ImageClassifier was given a 2D image")
+
+        num_cols = self._window_grid.shape[1]
+        accumulator = OverlapAddAccumulator(self.img_arr.shape)
+        for start, batch in zip(range(0, self.num_windows, batch_size), self.window_batches(batch_size)):
+            window_inds = np.arange(start, start + len(batch))
+            corners = np.stack([window_inds // num_cols, window_inds % num_cols], axis=1) * self.jump
+            accumulator.add_batch(corners, np.asarray(window_func(batch))[:, :, :, 0])
+
+        return accumulator.result()
+
+    def cnn_classify(self, perc_noise=0.05, perc_std=0.001, seed=None):
+        """
+        CNN classify every window, adding test-time speckle noise (seeded by seed) to each batch in place.
+        perc_std is unused, as noise is batchwise
+        """
+        self.cnn_window_inds = None
+        speckle_noise = SpeckleNoise(perc_noise, seed=seed)
+        if self._can_dense_classify():
+            self.cnn_preds = self._dense_cnn_preds(speckle_noise)
+        else:
+            num_uniques = len(np.unique(self._window_grid[0, 0]))
+            cnn_preds = []
+            for batch in self.window_batches():
+                noisy_batch = speckle_noise(batch, num_uniques)
+                cnn_preds.append(np.asarray(self.cnn_model.predict_on_batch(noisy_batch)))
+
+            self.cnn_preds = np.concatenate(cnn_preds)
+        self.cnn_majority_preds = self._majority_preds(self.cnn_preds)
 
-        self.cnn_preds = self.cnn_model.predict(noisy_array)
+    def adaptive_cnn_classify(self, perc_noise=0.05, perc_std=0.001, batch_size=64, min_windows=64,
+                              max_windows=None, mean_threshold=0.8, std_threshold=0.2, z_score=2., order="random",
+                              seed=None):
+        """
+        Classify windows a batch at a time, stopping as soon as the vote is settled rather than after every window
+
+        Windows are taken in random (or spatially stratified) order. A running mean and std of the class probabilities
+        is kept, and classification stops once both the top mean is clearly above or below mean_threshold and
+        every std clearly above or below std_threshold (the checks of FileFilter._CNN_classify), i.e. further than
+        z_score standard errors away. Standard errors use a finite population correction, as windows are drawn
+        without replacement from the image
+
+        Parameters
+        ----------
+        perc_noise, perc_std : float, optional
+            Speckle noise added to each batch, as for cnn_classify
+        batch_size : int, optional
+            Number of windows classified at once. Default 64
+        min_windows : int, optional
+            Number of windows to classify before stopping is considered. Default 64
+        max_windows : int or None, optional
+            Most windows to classify, for very large scans. Default None (no limit)
+        mean_threshold, std_threshold : float, optional
+            Thresholds the vote is settled against. Default 0.8 and 0.2
+        z_score : float, optional
+            Number of standard errors a statistic must be from its threshold to be settled. Default 2
+        order : str, optional
+            "random" (default), or "stratified" so every run of consecutive windows is spread across the image
+        seed : int or None, optional
+            Seed for the window order and noise. Default None
+
+        Notes
+        -----
+        cnn_preds holds only the windows classified, and cnn_window_inds their indices into cnn_arr
+        """
+        rng = np.random.default_rng(seed)
+        window_order = self._window_order(order, batch_size, rng)[:max_windows]
+        speckle_noise = SpeckleNoise(perc_noise, seed=rng)
+        num_uniques = len(np.unique(self._window_grid[0, 0]))
+        buffer = np.empty((min(batch_size, len(window_order)),) + self._window_grid.shape[2:] + (1,), dtype=np.float32)
+
+        cnn_preds = []
+        count, mean, m2 = 0, 0., 0.
+        for start in range(0, len(window_order), batch_size):
+            batch = self._fill_window_batch(buffer, window_order[start:start + batch_size])
+            noisy_batch = speckle_noise(batch, num_uniques)
+            batch_preds = np.asarray(self.cnn_model.predict_on_batch(noisy_batch))
+            cnn_preds.append(batch_preds)
+
+            # Combine the batch into the running (Welford) mean and sum of squared differences
+            batch_mean = batch_preds.mean(axis=0)
+            delta = batch_mean - mean
+            new_count = count + len(batch_preds)
+            mean = mean + delta * len(batch_preds) / new_count
+            m2 = m2 + np.sum((batch_preds - batch_mean) ** 2, axis=0) + \
+                 delta ** 2 * count * len(batch_preds) / new_count
+            count = new_count
+
+            if count >= min_windows and self._is_vote_settled(count, mean, m2, mean_threshold, std_threshold,
+                                                              z_score):
+                break
+
+        self.cnn_preds = np.concatenate(cnn_preds)
+        self.cnn_window_inds = window_order[:len(self.cnn_preds)]
         self.cnn_majority_preds = self._majority_preds(self.cnn_preds)
 
+    def _window_order(self, order, batch_size, rng):
+        """Order to classify windows in (indices into cnn_arr)"""
+        if order == "random":
+            return rng.permutation(self.num_windows)
+        elif order != "stratified":
+            raise ValueError(f"Unknown window order {order}")
+
+        # Split the grid of windows into about batch_size blocks, and take one window from each block in turn
+        num_rows, num_cols = self._window_grid.shape[:2]
+        blocks_per_side = max(1, int(np.sqrt(batch_size)))
+        window_rows, window_cols = np.divmod(np.arange(self.num_windows), num_cols)
+        block_ids = (window_rows * blocks_per_side // num_rows) * blocks_per_side + \
+                    window_cols * blocks_per_side // num_cols
+
+        window_order = rng.permutation(self.num_windows)
+        shuffled_blocks = block_ids[window_order]
+        block_sort = np.argsort(shuffled_blocks, kind="stable")
+        sorted_blocks = shuffled_blocks[block_sort]
+        rank_in_block = np.empty(self.num_windows, dtype=int)
+        rank_in_block[block_sort] = np.arange(self.num_windows) - np.searchsorted(sorted_blocks, sorted_blocks)
+
+        return window_order[np.argsort(rank_in_block, kind="stable")]
+
+    def _is_vote_settled(self, count, mean, m2, mean_threshold, std_threshold, z_score):
+        """If the running mean and std of the class probabilities are each clearly either side of their thresholds"""
+        std = np.sqrt(m2 / count)
+        finite_population_correction = np.sqrt((self.num_windows - count) / max(self.num_windows - 1, 1))
+        mean_error = z_score * finite_population_correction * std / np.sqrt(count)
+        std_error = z_score * finite_population_correction * std / np.sqrt(2 * max(count - 1, 1))
+
+        top_class = np.argmax(mean)
+        is_mean_settled = (mean[top_class] - mean_error[top_class] >= mean_threshold) or \
+                          np.all(mean + mean_error < mean_threshold)
+        is_std_settled = np.any(std - std_error > std_threshold) or np.all(std + std_error <= std_threshold)
+
+        return is_mean_settled and is_std_settled
+
+    def _can_dense_classify(self):
+        # Only Keras models can be made fully convolutional
+        return self.dense_inference and self.img_arr.ndim == 2 and not isinstance(self.cnn_model, TFLiteModel) and \
+               self.jump % get_output_stride(self.cnn_model) == 0
+
+    def _dense_cnn_preds(self, speckle_noise):
+        """
+        Predictions of every window in one forward pass over the whole image, in the same order as cnn_arr.
+        Noise is added to the whole image once, so overlapping windows share it
+        """
+        # The model gives a prediction every output stride pixels, so its head only needs to run every
+        # (window stride / output stride)th position
+        head_stride = self.jump // get_output_stride(self.cnn_model)
+        fcn_models = _fully_convolutional_models.setdefault(self.cnn_model, {})
+        if head_stride not in fcn_models:
+            fcn_models[head_stride] = make_fully_convolutional(self.cnn_model, head_stride)
+
+        noisy_img = speckle_noise(self.img_arr[np.newaxis, :, :, np.newaxis].astype(np.float32),
+                                  len(np.unique(self.img_arr)))
+        pred_grid = fcn_models[head_stride].predict(noisy_img)[0]
+
+        num_jumps = int((len(self.img_arr) - self.network_img_size) / self.jump)
+        pred_grid = pred_grid[:num_jumps, :num_jumps, :]
+
+        return pred_grid.reshape(-1, pred_grid.shape[-1])
+
     def euler_classify(self):
         cats = self.cats + ["none"]
-        self.euler_preds = np.zeros((len(self.cnn_arr), len(cats)))
+        self.euler_preds = np.zeros((self.num_windows, len(cats)))
 
-        for i, img in enumerate(self.cnn_arr):
-            _, pred = calculate_stats(img=img[:, :, 0], image_res=self.network_img_size, liquid_num=1,
-                                      substrate_num=0, nano_num=1)
+        # As calculate_stats(img=window, image_res=self.network_img_size, liquid_num=1, substrate_num=0, nano_num=1),
+        # but from the window feature table. Ties in the mode go to the smallest level, as with scipy.stats.mode
+        levels = np.unique(self._window_grid)
+        modes = levels[np.argmax([self.window_level_counts(level) for level in levels], axis=0)]
+        preds = categorise_windows(self.window_euler_numbers(), modes, self.window_level_counts(0),
+                                   self.window_level_counts(1), self.network_img_size, liquid_num=1)
+
+        for i, pred in enumerate(preds):
             self.euler_preds[i, cats.index(pred)] = 1
         self.euler_majority_preds = self._majority_preds(self.euler_preds)
 
     def minkowski_classify(self):
-        SIA = np.zeros((len(self.cnn_arr), 1))
-        SIP = np.zeros((len(self.cnn_arr), 1))
-        SIE = np.zeros((len(self.cnn_arr), 1))
-
-        for i, img in enumerate(self.cnn_arr):
-            SIA[i], SIP[i], SIE[i] = calculate_normalised_stats(img[:, :, 0])
-
-        x = np.hstack((SIA, SIP, SIE))
+        x = np.stack(self.window_minkowski_stats(), axis=1)
 
         self.minkowski_preds = self.sklearn_model.predict_proba(x)
         self.minkowski_majority_preds = self._majority_preds(self.minkowski_preds)
 
+    def _window_feature(self, name, compute_func):
+        """Look up a feature in window_features, computing it on first use"""
+        if name not in self.window_features:
+            self.window_features[name] = compute_func()
+        return self.window_features[name]
+
+    def _window_stack(self):
+        return self._window_grid.reshape((-1,) + self._window_grid.shape[2:])
+
+    def window_euler_numbers(self, last_region=False):
+        """
+        Euler number of regionprops((window != 0) + 1)[0] (or [-1] if last_region) of each window, in the order of
+        cnn_arr
+        """
+        def compute():
+            if self.img_arr.ndim == 2:
+                return window_euler_numbers(self.img_arr, self.network_img_size, self.jump, last_region)
+            else:
+                return region_euler_numbers_batch(self._window_stack(), last_region)
+
+        return self._window_feature("last_euler_number" if last_region else "euler_number", compute)
+
+    def window_level_counts(self, level):
+        """Number of pixels equal to level in each window, in the order of cnn_arr"""
+        def compute():
+            if self.img_arr.ndim == 2:
+                rows, cols = window_corners(self.img_arr.shape, self.network_img_size, self.jump)
+                return SlidingWindowEuler(self.img_arr == level).counts(rows, cols, self.network_img_size)
+            else:
+                return np.sum(self._window_stack() == level, axis=(-2, -1))
+
+        return self._window_feature(f"count_{level}", compute)
+
+    def window_region_shapes(self):
+        """
+        Eccentricity and equivalent diameter of regionprops((window != 0) + 1)[-1] of each window, in the order of
+        cnn_arr
+        """
+        def compute():
+            if self.img_arr.ndim == 2:
+                rows, cols = window_corners(self.img_arr.shape, self.network_img_size, self.jump)
+                zero_moments = SlidingWindowMoments(self.img_arr == 0).moments(rows, cols, self.network_img_size)
+                nonzero_moments = SlidingWindowMoments(self.img_arr != 0).moments(rows, cols, self.network_img_size)
+            else:
+                zero_moments = moments_batch(self._window_stack() == 0)
+                nonzero_moments = moments_batch(self._window_stack() != 0)
+
+            use_zeros = use_zero_region(self.window_level_counts(0), self.network_img_size ** 2, last_region=True)
+            moments = [np.where(use_zeros, zero_moment, nonzero_moment)
+                       for zero_moment, nonzero_moment in zip(zero_moments, nonzero_moments)]
+            eccentricity, equivalent_diameter = shape_stats_from_moments(*moments)
+            return {"last_eccentricity": eccentricity, "last_equivalent_diameter": equivalent_diameter}
+
+        if "last_eccentricity" not in self.window_features:
+            self.window_features.update(compute())
+        return self.window_features["last_eccentricity"], self.window_features["last_equivalent_diameter"]
+
+    def window_minkowski_stats(self):
+        """SIA, SIP and SIE (see calculate_normalised_stats) of each window, in the order of cnn_arr"""
+        if "SIA" not in self.window_features:
+            self.window_features.update(zip(["SIA", "SIP", "SIE"],
+                                            calculate_normalised_stats_batch(self._window_stack())))
+        return self.window_features["SIA"], self.window_features["SIP"], self.window_features["SIE"]
+
     @staticmethod
     def _majority_preds(arr):
         return np.mean(arr, axis=0)
 
 
+def cnn_classify_batch(image_classifiers, batch_size=256, perc_noise=0.05, perc_std=0.001, seed=None):
+    """
+    CNN classify the windows of many images together, so the model always runs on full batches
+
+    Windows of every image are packed back to back into fixed-size batches, across image boundaries, and the
+    predictions scattered back to each ImageClassifier's cnn_preds and cnn_majority_preds, as if each had called
+    cnn_classify without dense inference. Speckle noise is added per image, as the number of levels may differ
+
+    Parameters
+    ----------
+    image_classifiers : list of ImageClassifier
+        Classifiers sharing the same cnn_model
+    batch_size : int, optional
+        Number of windows per model call. Default 256
+    perc_noise, perc_std : float, optional
+        Speckle noise, as for ImageClassifier.cnn_classify
+    seed : int or None, optional
+        Seed for the noise. Default None
+    """
+    if not image_classifiers:
+        return
+
+    cnn_model = image_classifiers[0].cnn_model
+    assert all(classifier.cnn_model is cnn_model for classifier in image_classifiers), \
+        "All ImageClassifiers must share one cnn_model"
+
+    window_shape = image_classifiers[0]._window_grid.shape[2:]
+    buffer = np.empty((batch_size,) + window_shape + (1,), dtype=np.float32)
+    speckle_noise = SpeckleNoise(perc_noise, seed=seed)
+    classifier_preds = [[] for _ in image_classifiers]
+
+    # (classifier index, first window, last window) of each part of the batch being filled
+    batch_parts = []
+    num_filled = 0
+
+    def flush():
+        preds = np.asarray(cnn_model.predict_on_batch(buffer[:num_filled]))
+        start = 0
+        for classifier_ind, first_window, last_window in batch_parts:
+            classifier_preds[classifier_ind].append(preds[start:start + last_window - first_window])
+            start += last_window - first_window
+
+    for classifier_ind, classifier in enumerate(image_classifiers):
+        classifier.cnn_window_inds = None
+        num_uniques = len(np.unique(classifier._window_grid[0, 0]))
+
+        first_window = 0
+        while first_window < classifier.num_windows:
+            last_window = min(first_window + batch_size - num_filled, classifier.num_windows)
+            part = classifier._fill_window_batch(buffer[num_filled:], np.arange(first_window, last_window))
+            speckle_noise(part, num_uniques)
+            batch_parts.append((classifier_ind, first_window, last_window))
+            num_filled += last_window - first_window
+            first_window = last_window
+
+            if num_filled == batch_size:
+                flush()
+                batch_parts, num_filled = [], 0
+
+    if num_filled:
+        flush()
+
+    for classifier, preds in zip(image_classifiers, classifier_preds):
+        classifier.cnn_preds = np.concatenate(preds)
+        classifier.cnn_majority_preds = classifier._majority_preds(classifier.cnn_preds)
+
+
+def denoise_image(img, denoising_model, tile_size=512, overlap=32):
+    """
+    Denoise a whole image with a fully convolutional autoencoder, rather than each window separately
+
+    The image is reflect-padded to a multiple of the autoencoder's downsampling, cut into (at most) tile_size tiles
+    overlapping by overlap pixels, and every tile denoised in one predict call. Tiles are blended back with weights
+    that ramp down over the overlap, so there are no seams
+
+    Parameters
+    ----------
+    img : ndarray
+        2D binarised image
+    denoising_model : tensorflow.keras.Model or Models.quantise.TFLiteModel
+        Trained autoencoder (e.g. Models.model_CNN.autoencoder), of any input size. A TFLiteModel must have been
+        exported with any_size=True
+    tile_size : int, optional
+        Largest tile to denoise at once, to bound memory. Must be a multiple of the autoencoder's downsampling.
+        Default 512
+    overlap : int, optional
+        Overlap between neighbouring tiles. Default 32
+
+    Returns
+    -------
+    denoised_img : ndarray
+        Rounded denoised image, the same size as img
+    """
+    if isinstance(denoising_model, TFLiteModel):
+        # Exported with export_tflite(..., any_size=True), so already takes any size
+        alignment = denoising_model.output_stride
+        any_size_model = denoising_model
+    else:
+        alignment = get_output_stride(denoising_model)
+        if denoising_model not in _any_size_models:
+            any_size_model = clone_model(denoising_model, input_tensors=Input(shape=(None, None, 1)))
+            any_size_model.set_weights(denoising_model.get_weights())
+            _any_size_models[denoising_model] = any_size_model
+        any_size_model = _any_size_models[denoising_model]
+    assert tile_size % alignment == 0, f"tile_size must be a multiple of {alignment}"
+
+    # Pooling needs the image to divide evenly
+    padded_img = np.pad(img, ((0, -img.shape[0] % alignment), (0, -img.shape[1] % alignment)), mode="reflect")
+    tile_shape = (min(tile_size, padded_img.shape[0]), min(tile_size, padded_img.shape[1]))
+
+    tile_corners = list(itertools.product(_tile_starts(padded_img.shape[0], tile_shape[0], overlap),
+                                          _tile_starts(padded_img.shape[1], tile_shape[1], overlap)))
+    tiles = np.stack([padded_img[i:i + tile_shape[0], j:j + tile_shape[1]] for i, j in tile_corners])
+    denoised_tiles = any_size_model.predict(tiles[:, :, :, np.newaxis].astype(np.float32))
+
+    blend_weights = np.outer(_blend_ramp(tile_shape[0], overlap), _blend_ramp(tile_shape[1], overlap))
+    accumulator = OverlapAddAccumulator(padded_img.shape)
+    accumulator.add_batch(tile_corners, denoised_tiles[:, :, :, 0], blend_weights)
+
+    return np.round(accumulator.result())[:img.shape[0], :img.shape[1]]
+
+
+def _tile_starts(length, tile_length, overlap):
+    """Start of each tile along an axis, with the last tile flush with the end"""
+    if tile_length >= length:
+        return [0]
+    return list(range(0, length - tile_length, tile_length - overlap)) + [length - tile_length]
+
+
+def _blend_ramp(tile_length, overlap):
+    """Blending weight along a tile, rising linearly over the overlap at each end"""
+    dist_to_edge = np.minimum(np.arange(tile_length), np.arange(tile_length)[::-1]) + 1
+    return np.minimum(dist_to_edge / max(overlap, 1), 1)
+
+
 if __name__ == '__main__':
-    trained_model = load_model(
-        "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks/2020-06-15--12-18/model.h5")
+    from Models.registry import get_trained_model
+
+    trained_model = get_trained_model("classifier")
 
     testing_data_dir = "/home/mltest1/tmp/pycharm_project_883/Data/Simulated_Images/NewTest"
     original_categories = ["liquid", "hole", "cellular", "labyrinth", "island"]
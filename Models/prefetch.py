@@ -0,0 +1,214 @@
+import ctypes
+import multiprocessing as mp
+import threading
+import time
+import traceback
+from collections import deque
+
+import numpy as np
+from tensorflow.python.keras.utils import Sequence
+
+
+class SharedMemoryPrefetcher(Sequence):
+    def __init__(self, generator, num_workers=4, num_slots=None, shuffle=True, seed=None):
+        """
+        Wraps a keras Sequence (e.g. Models.h5_iterator.h5RabaniDataGenerator) so batches are made ahead of time by
+        background processes
+
+        Each batch is written in place into one of a ring of preallocated shared-memory slots, so it is never pickled
+        between processes, and __getitem__ returns views of the slot, so it is never copied. The slot is handed back
+        to the workers when the next batch is asked for, so a batch is only valid until then: fit with workers=0,
+        so keras doesn't read ahead of the model
+
+        Parameters
+        ----------
+        generator : Sequence
+            Generator to prefetch from. Must allow random access, i.e. generator[idx] can be called in any order,
+            and give batches of the same shape and dtype every time
+        num_workers : int, optional
+            Number of background processes. Default 4
+        num_slots : int or None, optional
+            Number of batches that can be held at once, including the one in use. Default None (2 * num_workers)
+        shuffle : bool, optional
+            Shuffle the batch order every epoch. Default True
+        seed : int or None, optional
+            Seed for the batch order and for each worker's numpy RNG. Default None
+
+        Notes
+        -----
+        Batches come back in the order they finish rather than the order of idx, so idx only counts batches.
+        The generator is copied into each worker when it starts, so state changed on it afterwards (e.g. the
+        validation truth x_true/y_true) is not shared with the workers. The epoch is sent with every batch, for
+        generators with a set_epoch method
+        """
+        super().__init__()
+        self.generator = generator
+        self.num_workers = num_workers
+        self.num_slots = num_slots or 2 * num_workers
+        assert self.num_slots > num_workers, "Need at least one slot per worker, and one for the batch in use"
+        self.shuffle = shuffle
+        self._rng = np.random.default_rng(seed)
+
+        # Probe one batch for the shapes and dtypes of the slots
+        probe_batch = generator[0]
+        self._is_tuple = type(probe_batch) is tuple
+        probe_batch = probe_batch if self._is_tuple else (probe_batch,)
+        self._specs = [(arr.shape, arr.dtype) for arr in probe_batch]
+        self._buffers = [mp.RawArray(ctypes.c_uint8, self.num_slots * int(np.prod(shape)) * dtype.itemsize)
+                         for shape, dtype in self._specs]
+
+        self._task_queue = mp.Queue()
+        self._done_queue = mp.Queue()
+        self._num_ready = mp.Value(ctypes.c_int32, 0)
+        self._idx_stream = self._epoch_indices()
+        # Slot of the batch last handed out, which is refilled once the next is asked for
+        self._held_slot = None
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.wait_times = []
+        self.queue_depths = []
+        self.fill_times = []
+        self.batch_timings = deque(maxlen=1000)
+
+        self._workers = []
+        for worker_id in range(num_workers):
+            worker_seed = None if seed is None else seed + worker_id
+            worker = mp.Process(target=_prefetch_worker,
+                                args=(generator, self._slot_views, self._task_queue, self._done_queue,
+                                      self._num_ready, worker_seed),
+                                daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        for slot in range(self.num_slots):
+            self._submit(slot)
+
+    def __len__(self):
+        return len(self.generator)
+
+    @property
+    def class_weights_dict(self):
+        return getattr(self.generator, "class_weights_dict", None)
+
+    def _epoch_indices(self):
+        """Never-ending stream of (epoch, batch index), so slots are refilled across epoch boundaries"""
+        epoch = getattr(self.generator, "epoch", 0)
+        while True:
+            inds = np.arange(len(self.generator))
+            if self.shuffle:
+                self._rng.shuffle(inds)
+            for idx in inds:
+                yield epoch, int(idx)
+            epoch += 1
+
+    def _slot_views(self, slot):
+        """Numpy views of every array in a slot"""
+        views = []
+        for buffer, (shape, dtype) in zip(self._buffers, self._specs):
+            slot_arrs = np.frombuffer(buffer, dtype=dtype).reshape((self.num_slots,) + shape)
+            views.append(slot_arrs[slot])
+        return views
+
+    def _submit(self, slot):
+        self._task_queue.put((slot,) + next(self._idx_stream))
+
+    def __getitem__(self, idx):
+        """Get the next finished batch, as views of its shared-memory slot"""
+        with self._lock:
+            # The last batch has been used, so its slot can be refilled
+            if self._held_slot is not None:
+                self._submit(self._held_slot)
+                self._held_slot = None
+
+            self.queue_depths.append(self._num_ready.value)
+            start_time = time.perf_counter()
+            slot, batch_idx, fill_time, timings, error = self._done_queue.get()
+            self.wait_times.append(time.perf_counter() - start_time)
+
+            if error is not None:
+                self._submit(slot)
+                raise RuntimeError(f"Prefetch worker failed on batch {batch_idx}:\n{error}")
+
+            with self._num_ready.get_lock():
+                self._num_ready.value -= 1
+            self.fill_times.append(fill_time)
+            self._held_slot = slot
+
+            # The generator's own timings come from the worker, alongside how long this process waited for them.
+            # The batch is ready when it reaches this process
+            timings = dict(timings or {}, queue_wait=self.wait_times[-1], queue_depth=self.queue_depths[-1],
+                           ready=time.perf_counter())
+            self.batch_timings.append(timings)
+
+        batch = self._slot_views(slot)
+        return tuple(batch) if self._is_tuple else batch[0]
+
+    def on_epoch_end(self):
+        self.generator.on_epoch_end()
+
+    def stats(self):
+        """
+        Summarise the queue depth and wait time metrics. If the model is regularly waiting on an empty queue,
+        training is input-bound and more workers are needed
+
+        Returns
+        -------
+        stats : dict
+            Number of batches, mean and total time waited for a batch (s), mean number of finished batches waiting
+            to be used, fraction of batches requested when none were ready, and mean time to make a batch (s)
+        """
+        num_batches = len(self.wait_times)
+        if num_batches == 0:
+            return {"batches": 0}
+
+        return {"batches": num_batches,
+                "mean_wait": float(np.mean(self.wait_times)),
+                "total_wait": float(np.sum(self.wait_times)),
+                "mean_queue_depth": float(np.mean(self.queue_depths)),
+                "empty_queue_fraction": float(np.mean(np.array(self.queue_depths) == 0)),
+                "mean_fill_time": float(np.mean(self.fill_times))}
+
+    def stop(self):
+        """Stop the prefetch processes"""
+        if not self._workers:
+            return
+
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def __del__(self):
+        if hasattr(self, "_workers"):
+            self.stop()
+
+
+def _prefetch_worker(generator, slot_views, task_queue, done_queue, num_ready, seed):
+    """Fill slots with batches from the generator until sent None"""
+    # Forked workers would otherwise all share the parent's RNG state, and so the same augmentations
+    np.random.seed(seed)
+
+    for task in iter(task_queue.get, None):
+        slot, epoch, batch_idx = task
+        start_time = time.perf_counter()
+        try:
+            if hasattr(generator, "set_epoch") and generator.epoch != epoch:
+                generator.set_epoch(epoch)
+            # A generator that rescans may have fewer batches in this worker than when the index was drawn
+            batch = generator[batch_idx % len(generator)]
+            batch = batch if type(batch) is tuple else (batch,)
+            for view, arr in zip(slot_views(slot), batch):
+                view[...] = arr
+        except Exception:
+            done_queue.put((slot, batch_idx, None, None, traceback.format_exc()))
+            continue
+
+        with num_ready.get_lock():
+            num_ready.value += 1
+        batch_timings = getattr(generator, "batch_timings", None)
+        timings = batch_timings[-1] if batch_timings else None
+        done_queue.put((slot, batch_idx, time.perf_counter() - start_time, timings, None))
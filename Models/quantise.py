@@ -0,0 +1,231 @@
+import json
+import os
+import time
+import weakref
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Input
+from tensorflow.keras.models import clone_model
+
+from Models.model_CNN import get_output_stride
+
+# TFLite versions of Keras models, converted once per model and (any_size, is_calibrated)
+_tflite_models = weakref.WeakKeyDictionary()
+
+
+class TFLiteModel:
+    def __init__(self, model_content, num_threads=None, output_stride=None):
+        """
+        A TFLite model with the parts of the Keras model API that Models.predict uses (input_shape, predict,
+        predict_on_batch), so it can stand in for a classifier or denoiser on CPU-only machines
+
+        Parameters
+        ----------
+        model_content : bytes or str
+            Flatbuffer of the model (as returned by export_tflite), or the path to a .tflite file
+        num_threads : int or None, optional
+            Number of CPU threads for the interpreter. Default None (TFLite's default)
+        output_stride : int or None, optional
+            get_output_stride of the original Keras model. Needed for denoising, as the image must be padded to a
+            multiple of the autoencoder's downsampling. Default None (read from the .json export_tflite writes next
+            to the .tflite file, or 1 if there isn't one)
+        """
+        if isinstance(model_content, str):
+            self.interpreter = tf.lite.Interpreter(model_path=model_content, num_threads=num_threads)
+            if output_stride is None and os.path.isfile(f"{model_content}.json"):
+                with open(f"{model_content}.json") as f:
+                    output_stride = json.load(f)["output_stride"]
+        else:
+            self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+        self.output_stride = output_stride or 1
+
+        self._input_details = self.interpreter.get_input_details()[0]
+        self._output_details = self.interpreter.get_output_details()[0]
+        self.input_shape = tuple(None if dim == -1 else int(dim) for dim in self._input_details["shape_signature"])
+        self._allocated_shape = None
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=self._input_details["dtype"])
+
+        # The interpreter has a fixed input shape, so is resized whenever the batch shape changes
+        if x.shape != self._allocated_shape:
+            self.interpreter.resize_tensor_input(self._input_details["index"], x.shape, strict=False)
+            self.interpreter.allocate_tensors()
+            self._allocated_shape = x.shape
+
+        self.interpreter.set_tensor(self._input_details["index"], x)
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self._output_details["index"]).copy()
+
+    def predict(self, x, batch_size=32, **kwargs):
+        return np.concatenate([self.predict_on_batch(x[i:i + batch_size]) for i in range(0, len(x), batch_size)])
+
+
+def export_tflite(model, output_path=None, calibration_generator=None, num_calibration_batches=10, any_size=False,
+                  num_threads=None):
+    """
+    Convert a Keras model (e.g. from Models.model_CNN) to TFLite, with post-training quantisation
+
+    With calibration data, weights and activations are quantised to int8 (keeping float32 inputs and outputs).
+    Without, only weights are quantised (dynamic range quantisation)
+
+    Parameters
+    ----------
+    model : tensorflow.keras.Model
+        Trained classifier or autoencoder
+    output_path : str or None, optional
+        Where to write the .tflite file, alongside a .json of its output stride so TFLiteModel (and
+        Models.registry.get_trained_model) can load it back. Default None (not written)
+    calibration_generator : Sequence or None, optional
+        Simulated data to calibrate activation ranges with, e.g. Models.h5_iterator.h5RabaniDataGenerator with
+        is_train=False. Default None (dynamic range quantisation)
+    num_calibration_batches : int, optional
+        Number of batches of calibration_generator to use. Default 10
+    any_size : bool, optional
+        Export with any input height/width, for fully convolutional models such as the denoiser. Default False
+    num_threads : int or None, optional
+        As for TFLiteModel
+
+    Returns
+    -------
+    tflite_model : TFLiteModel
+    """
+    if any_size:
+        any_size_model = clone_model(model, input_tensors=Input(shape=(None, None, model.input_shape[-1])))
+        any_size_model.set_weights(model.get_weights())
+        converter = tf.lite.TFLiteConverter.from_keras_model(any_size_model)
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if calibration_generator is not None:
+        converter.representative_dataset = lambda: _calibration_samples(calibration_generator,
+                                                                        num_calibration_batches)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    model_content = converter.convert()
+    output_stride = get_output_stride(model)
+    if output_path:
+        with open(output_path, "wb") as f:
+            f.write(model_content)
+        with open(f"{output_path}.json", "w") as f:
+            json.dump({"output_stride": output_stride}, f)
+
+    return TFLiteModel(model_content, num_threads, output_stride=output_stride)
+
+
+def _calibration_samples(generator, num_batches):
+    for i in range(min(num_batches, len(generator))):
+        batch = generator[i]
+        batch_x = batch[0] if type(batch) is tuple else batch
+        for sample in batch_x:
+            yield [sample[np.newaxis].astype(np.float32)]
+
+
+def select_runtime(model, runtime="keras", calibration_generator=None, any_size=False):
+    """
+    Get the model to run inference with
+
+    Parameters
+    ----------
+    model : tensorflow.keras.Model or TFLiteModel
+        Trained model. A TFLiteModel (e.g. a .tflite file from export_tflite, loaded with
+        Models.registry.get_trained_model) is used as it is
+    runtime : str, optional
+        "keras" (default) to use model as it is, or "tflite" for a quantised TFLite version. Keras models are
+        converted once and reused
+    calibration_generator : Sequence or None, optional
+        As for export_tflite. Without it (the default), conversion only quantises the weights (dynamic range
+        quantisation), not the full int8 quantisation that calibration gives
+    any_size : bool, optional
+        As for export_tflite. Set for denoisers
+
+    Returns
+    -------
+    model : tensorflow.keras.Model or TFLiteModel
+    """
+    if runtime == "keras" or isinstance(model, TFLiteModel):
+        return model
+    elif runtime != "tflite":
+        raise ValueError("runtime must be one of ['keras', 'tflite']")
+
+    conversions = _tflite_models.setdefault(model, {})
+    key = (any_size, calibration_generator is not None)
+    if key not in conversions:
+        conversions[key] = export_tflite(model, calibration_generator=calibration_generator, any_size=any_size)
+    return conversions[key]
+
+
+def compare_runtimes(keras_model, tflite_model, generator, num_batches=None):
+    """
+    Compare a TFLite model against the Keras model it came from, on batches of simulated data
+
+    Parameters
+    ----------
+    keras_model : tensorflow.keras.Model
+    tflite_model : TFLiteModel
+    generator : Sequence
+        Simulated data, e.g. Models.h5_iterator.h5RabaniDataGenerator with is_train=False
+    num_batches : int or None, optional
+        Number of batches to compare on. Default None (all)
+
+    Returns
+    -------
+    stats : dict
+        Mean latency per batch (s) and throughput (samples/s) of each runtime. For classifiers, the accuracy of
+        each, its change, and the fraction of predictions that agree. For autoencoders, the mean absolute error
+        of each against the clean images. For both, the largest absolute difference between the two outputs
+    """
+    num_batches = min(num_batches or len(generator), len(generator))
+    timings = {"keras": [], "tflite": []}
+    outputs = {"keras": [], "tflite": []}
+    truths = []
+    num_samples = 0
+
+    for i in range(num_batches):
+        batch_x, batch_y = generator[i]
+        num_samples += len(batch_x)
+        truths.append(batch_y)
+        for runtime, model in [("keras", keras_model), ("tflite", tflite_model)]:
+            start_time = time.perf_counter()
+            outputs[runtime].append(np.asarray(model.predict_on_batch(batch_x)))
+            timings[runtime].append(time.perf_counter() - start_time)
+
+    truth = np.concatenate(truths)
+    stats = {}
+    for runtime in ["keras", "tflite"]:
+        outputs[runtime] = np.concatenate(outputs[runtime])
+        stats[f"{runtime}_latency"] = float(np.mean(timings[runtime]))
+        stats[f"{runtime}_throughput"] = num_samples / float(np.sum(timings[runtime]))
+
+    if truth.ndim == 2:
+        for runtime in ["keras", "tflite"]:
+            stats[f"{runtime}_accuracy"] = float(np.mean(outputs[runtime].argmax(axis=1) == truth.argmax(axis=1)))
+        stats["accuracy_delta"] = stats["tflite_accuracy"] - stats["keras_accuracy"]
+        stats["agreement"] = float(np.mean(outputs["keras"].argmax(axis=1) == outputs["tflite"].argmax(axis=1)))
+    else:
+        for runtime in ["keras", "tflite"]:
+            stats[f"{runtime}_mae"] = float(np.mean(np.abs(outputs[runtime] - truth)))
+    stats["max_abs_difference"] = float(np.max(np.abs(outputs["keras"] - outputs["tflite"])))
+
+    return stats
+
+
+if __name__ == '__main__':
+    from tensorflow.python.keras.models import load_model
+    from Models.h5_iterator import h5RabaniDataGenerator
+
+    model_path = "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks/2020-06-15--12-18/model.h5"
+    data_dir = "/home/mltest1/tmp/pycharm_project_883/Data/Simulated_Images/2020-03-30/16-44"
+    cats = ['liquid', 'hole', 'cellular', 'labyrinth', 'island']
+
+    trained_model = load_model(model_path)
+    data_generator = h5RabaniDataGenerator(data_dir, network_type="classifier", batch_size=128, is_train=False,
+                                           imsize=trained_model.input_shape[1], output_parameters_list=[],
+                                           output_categories_list=cats, force_binarisation=True)
+
+    quantised_model = export_tflite(trained_model, model_path.replace(".h5", ".tflite"),
+                                    calibration_generator=data_generator)
+    print(compare_runtimes(trained_model, quantised_model, data_generator, num_batches=20))
@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+from tensorflow.python.keras.models import load_model
+
+from Models.quantise import TFLiteModel
+from Models.train_regression import load_sklearn_model
+
+TRAINED_NETWORKS_DIR = "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks"
+
+# Trained models used for screening, by name
+MODEL_PATHS = {
+    "classifier": f"{TRAINED_NETWORKS_DIR}/2020-06-15--12-18/model.h5",
+    "denoiser": f"{TRAINED_NETWORKS_DIR}/2020-05-29--14-07/model.h5",
+    "minkowski": f"{TRAINED_NETWORKS_DIR}/2020-07-28--11-15/model.p",
+}
+
+# Models loaded so far, by (process ID, path). Forked workers inherit the parent's dictionary, but not a usable
+# TensorFlow session, so the process ID makes each worker load its own copy
+_loaded_models = {}
+
+
+def register_model(name, path):
+    """Add (or replace) a named model, so it can be loaded with get_trained_model(name)"""
+    MODEL_PATHS[name] = path
+
+
+def get_trained_model(name_or_path, warm_up=True):
+    """
+    Get a trained model, loading it the first time it is asked for in this process and reusing it afterwards
+
+    Parameters
+    ----------
+    name_or_path : str
+        Name of a model in MODEL_PATHS, or the path to a model. ".h5" files are loaded with Keras, ".tflite" files
+        as Models.quantise.TFLiteModel, and anything else (e.g. ".p") with Models.train_regression.load_sklearn_model
+    warm_up : bool, optional
+        Run one inference on a blank batch after loading neural networks, so the first real batch isn't slowed by
+        graph building and memory allocation. Default True
+
+    Returns
+    -------
+    model : tensorflow.keras.Model, TFLiteModel or sklearn estimator
+    """
+    path = MODEL_PATHS.get(name_or_path, name_or_path)
+    key = (os.getpid(), path)
+
+    if key not in _loaded_models:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No model called {name_or_path} (registered models are {list(MODEL_PATHS)})")
+
+        extension = os.path.splitext(path)[1]
+        if extension == ".h5":
+            model = load_model(path)
+        elif extension == ".tflite":
+            model = TFLiteModel(path)
+        else:
+            model = load_sklearn_model(path)
+
+        if warm_up and extension in [".h5", ".tflite"]:
+            _warm_up(model)
+        _loaded_models[key] = model
+
+    return _loaded_models[key]
+
+
+def _warm_up(model, default_size=64):
+    """Predict a single blank image, with any unknown height/width set to default_size"""
+    input_shape = [1] + [dim or default_size for dim in model.input_shape[1:]]
+    model.predict_on_batch(np.zeros(input_shape, dtype=np.float32))
+
+
+def init_worker(*names_or_paths):
+    """
+    Load models as a worker process starts, so files are never held up by loading, e.g.
+    multiprocessing.get_context("spawn").Pool(initializer=init_worker, initargs=("classifier", "denoiser"))
+
+    TensorFlow can hang in processes forked after it has started, so workers using neural networks should be spawned
+    """
+    for name_or_path in names_or_paths:
+        get_trained_model(name_or_path)
+
+
+def clear_models():
+    """Forget every model this process has loaded, e.g. after retraining one in place"""
+    for key in [key for key in _loaded_models if key[0] == os.getpid()]:
+        del _loaded_models[key]
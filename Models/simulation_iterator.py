@@ -0,0 +1,326 @@
+import ctypes
+import multiprocessing as mp
+import time
+import warnings
+from collections import deque
+
+import numpy as np
+
+from Analysis.image_stats import calculate_stats_batch
+from Models.h5_iterator import h5RabaniDataGenerator
+from Models.utils import resize_image
+from Rabani_Simulation.rabani import _run_rabani_sweep
+
+PARAMETER_ORDER = ["kT", "mu", "MR", "C", "e_nl", "e_nn", "L", "MCS_max"]
+
+
+class SimulatedRabaniDataGenerator(h5RabaniDataGenerator):
+    def __init__(self, params, network_type, batch_size, output_categories_list, imsize, steps_per_epoch,
+                 is_train=True, num_workers=1, threads_per_worker=None, sims_per_sweep=8, queue_size=1024,
+                 category_weights="balanced", pool_size=256, horizontal_flip=True, vertical_flip=True,
+                 x_noise=0.005, circshift=True, randomise_levels=False, force_binarisation=True,
+                 storage_dtype=np.uint8, output_dtype=np.float32, seed=None):
+        """
+        A keras data generator that simulates rabanis on the fly, so training needs no stored dataset
+
+        Background processes run Rabani_Simulation.rabani._run_rabani_sweep on freshly sampled parameters,
+        categorise each simulation with calculate_stats, resize it and push it into a bounded shared-memory ring.
+        Batches are drawn from the ring, optionally rebalanced across categories
+
+        Parameters
+        ----------
+        params : dict[str | int or float] or dict[str | list[int or float, int or float]] or dict[str | object]
+            Values of kT, mu, MR, C, e_nl, e_nn, L and MCS_max. Single values are fixed, a list of [min max] is
+            sampled uniformly, and anything with an rvs method (e.g. a frozen scipy.stats distribution) is sampled
+            from. If MCS_max is not fixed, early stopping will be disabled
+        network_type : str
+            The calling network type. Must be one of ["classifier", "autoencoder"]
+        batch_size : int
+            Number of items to return every time __getitem__() is called
+        output_categories_list : iterable of str
+            Categories to be predicted. Simulations categorised as anything else are discarded
+        imsize : int
+            Size to enlarge each simulation to
+        steps_per_epoch : int
+            Number of batches that make up an "epoch", as the data is unlimited
+        is_train : bool, optional
+            If True, augmentations will be applied. Default True
+        num_workers : int, optional
+            Number of simulation processes. Default 1
+        threads_per_worker : int or None, optional
+            Numba threads for each process. Default None (numba's default, i.e. all cores)
+        sims_per_sweep : int, optional
+            Number of simulations run in parallel by each call to _run_rabani_sweep. Default 8
+        queue_size : int, optional
+            Number of simulations the shared-memory ring can hold before workers block. Default 1024
+        category_weights : str or list of float or None, optional
+            Proportion of each category in a batch. "balanced" (default) for equal proportions, or None to take
+            simulations in the order they finish
+        pool_size : int, optional
+            Maximum simulations held back per category while balancing. Default 256. A category with none after
+            50 * batch_size attempts is starved, and dropped from the proportions until one turns up
+        seed : int or None, optional
+            Seed for parameter sampling. Default None
+        horizontal_flip, vertical_flip, x_noise, circshift, randomise_levels, force_binarisation, storage_dtype,
+        output_dtype
+            As for Models.h5_iterator.h5RabaniDataGenerator
+
+        See Also
+        --------
+        Models.h5_iterator.h5RabaniDataGenerator
+        Rabani_Simulation.gen_rabanis.RabaniSweeper
+        """
+        # h5RabaniDataGenerator.__init__ scans a directory of simulations, so only keras' initialisation is wanted
+        super(h5RabaniDataGenerator, self).__init__()
+
+        self.params = params
+        self.batch_size = batch_size
+        self.original_categories_list = list(output_categories_list)
+        self.network_type = network_type
+        assert network_type in ['classifier', 'autoencoder']
+
+        self.image_res = imsize
+        self.steps_per_epoch = steps_per_epoch
+        self.is_training_set = is_train
+        self.is_validation_set = False
+
+        self.hflip = horizontal_flip
+        self.vflip = vertical_flip
+        self.xnoise = x_noise
+        self.circshift = circshift
+        self.randomise_levels = randomise_levels
+        self.force_binarisation = force_binarisation
+        self.storage_dtype = storage_dtype
+        self.output_dtype = output_dtype
+
+        # Batches are rebalanced directly, so keras doesn't need to reweight
+        self.class_weights_dict = None
+
+        num_cats = len(self.original_categories_list)
+        if category_weights == "balanced":
+            self.category_weights = np.ones(num_cats) / num_cats
+        elif category_weights is None:
+            self.category_weights = None
+        else:
+            self.category_weights = np.array(category_weights) / np.sum(category_weights)
+        self._pools = [deque(maxlen=pool_size) for _ in range(num_cats)]
+        self._starved = set()
+        self.batch_timings = deque(maxlen=1000)
+
+        self._ring = _SampleRing(queue_size, imsize)
+        self._stop_event = mp.Event()
+        self._workers = []
+        for worker_id in range(num_workers):
+            worker_seed = None if seed is None else seed + worker_id
+            worker = mp.Process(target=_simulation_worker,
+                                args=(params, sims_per_sweep, imsize, self.original_categories_list, self._ring,
+                                      self._stop_event, threads_per_worker, worker_seed),
+                                daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def on_epoch_end(self):
+        """Simulations are never exhausted, so there is nothing to reset"""
+        pass
+
+    def stop(self):
+        """Stop the simulation processes"""
+        if not self._workers:
+            return
+
+        self._stop_event.set()
+        for worker in self._workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+
+    def __del__(self):
+        if hasattr(self, "_workers"):
+            self.stop()
+
+    def _get_simulation(self):
+        """Take the next simulation from the ring, raising rather than waiting forever if every worker has died"""
+        sample = self._ring.get(timeout=1)
+        while sample is None:
+            if not any(worker.is_alive() for worker in self._workers):
+                raise RuntimeError("Every simulation worker has stopped, so no more simulations will arrive")
+            sample = self._ring.get(timeout=1)
+        return sample
+
+    def _sampling_weights(self):
+        """category_weights without starved categories, unless simulations of them have since turned up"""
+        weights = self.category_weights.copy()
+        for category_ind in self._starved:
+            if not self._pools[category_ind]:
+                weights[category_ind] = 0
+        return weights / weights.sum() if weights.sum() else None
+
+    def _next_sample(self, category_ind):
+        """Take a simulation of the given category, pulling from the ring (and holding back others) until one exists"""
+        max_pulls = 50 * self.batch_size
+        num_pulls = 0
+        while not self._pools[category_ind]:
+            if num_pulls >= max_pulls:
+                # Parameter distribution rarely (or never) gives this category, so stop asking for it
+                warnings.warn(f"No '{self.original_categories_list[category_ind]}' simulations after "
+                              f"{max_pulls} attempts. Leaving it out of batches until one is simulated")
+                self._starved.add(category_ind)
+                category_ind = int(np.argmax([len(pool) for pool in self._pools]))
+                break
+
+            img, sample_category_ind = self._get_simulation()
+            self._pools[sample_category_ind].append(img)
+            num_pulls += 1
+
+        return self._pools[category_ind].popleft(), category_ind
+
+    def __getitem__(self, idx):
+        """Get self.batch_size number of freshly simulated items, shaped and augmented"""
+        start_time = time.perf_counter()
+        batch_x = np.empty((self.batch_size, self.image_res, self.image_res, 1), dtype=self.storage_dtype)
+        batch_y = np.zeros((self.batch_size, len(self.original_categories_list)), dtype=self.output_dtype)
+
+        for i in range(self.batch_size):
+            sampling_weights = None if self.category_weights is None else self._sampling_weights()
+            if sampling_weights is None:
+                img, category_ind = self._get_simulation()
+            else:
+                requested_ind = np.random.choice(len(sampling_weights), p=sampling_weights)
+                img, category_ind = self._next_sample(requested_ind)
+
+            batch_x[i, :, :, 0] = img
+            batch_y[i, category_ind] = 1
+        load_time = time.perf_counter()
+
+        if self.is_training_set:
+            batch_x = self._augment(batch_x)
+        augment_time = time.perf_counter()
+
+        if self.force_binarisation:
+            batch_x = self._patch_binarisation(batch_x)
+
+        # "load" is time spent waiting on the simulation workers
+        ready_time = time.perf_counter()
+        self.batch_timings.append({"load": load_time - start_time, "augment": augment_time - load_time,
+                                   "binarise": ready_time - augment_time, "ready": ready_time})
+
+        if self.network_type == "classifier":
+            return batch_x.astype(self.output_dtype, copy=False), batch_y
+        else:
+            noisy_x = self.speckle_noise(batch_x.copy(), perc_noise=0.4, perc_std=0.005)
+            return noisy_x.astype(self.output_dtype, copy=False), batch_x.astype(self.output_dtype, copy=False)
+
+
+class _SampleRing:
+    """
+    A bounded multi-producer/multi-consumer queue of (imsize x imsize) uint8 images and their category index,
+    stored in shared memory so samples are copied once rather than pickled through a pipe
+    """
+
+    def __init__(self, capacity, imsize):
+        self.capacity = capacity
+        self.imsize = imsize
+
+        self._imgs = mp.RawArray(ctypes.c_uint8, capacity * imsize * imsize)
+        self._category_inds = mp.RawArray(ctypes.c_int32, capacity)
+        self._head = mp.RawValue(ctypes.c_int64, 0)
+        self._tail = mp.RawValue(ctypes.c_int64, 0)
+
+        self._lock = mp.Lock()
+        self._num_empty = mp.Semaphore(capacity)
+        self._num_filled = mp.Semaphore(0)
+
+    def _slots(self):
+        imgs = np.frombuffer(self._imgs, dtype=np.uint8).reshape(self.capacity, self.imsize, self.imsize)
+        return imgs, np.frombuffer(self._category_inds, dtype=np.int32)
+
+    def put(self, img, category_ind, timeout=None):
+        if not self._num_empty.acquire(timeout=timeout):
+            return False
+
+        imgs, category_inds = self._slots()
+        with self._lock:
+            slot = self._head.value % self.capacity
+            imgs[slot] = img
+            category_inds[slot] = category_ind
+            self._head.value += 1
+        self._num_filled.release()
+
+        return True
+
+    def get(self, timeout=None):
+        if not self._num_filled.acquire(timeout=timeout):
+            return None
+
+        imgs, category_inds = self._slots()
+        with self._lock:
+            slot = self._tail.value % self.capacity
+            img = imgs[slot].copy()
+            category_ind = int(category_inds[slot])
+            self._tail.value += 1
+        self._num_empty.release()
+
+        return img, category_ind
+
+    def qsize(self):
+        return self._head.value - self._tail.value
+
+
+def sample_parameters(params, num_sims, rng):
+    """
+    Sample num_sims sets of rabani parameters, in the (N x 9) layout taken by _run_rabani_sweep.
+    L is shared by every simulation, as _run_rabani_sweep requires
+    """
+
+    def sample(param, size):
+        if hasattr(param, "rvs"):
+            return np.asarray(param.rvs(size=size, random_state=rng), dtype=float)
+        elif type(param) is list:
+            return rng.uniform(param[0], param[1], size)
+        else:
+            return np.full(size, float(param))
+
+    sampled = np.zeros((num_sims, 9))
+    for i, param_key in enumerate(PARAMETER_ORDER):
+        if param_key == "L":
+            sampled[:, i] = np.round(sample(params["L"], 1))
+        elif param_key in ["MR", "MCS_max"]:
+            sampled[:, i] = np.round(sample(params[param_key], num_sims))
+        else:
+            sampled[:, i] = sample(params[param_key], num_sims)
+
+    # Early stopping is disabled if MCS_max is being varied (see RabaniSweeper.call_rabani_sweep)
+    is_mcs_fixed = not (type(params["MCS_max"]) is list or hasattr(params["MCS_max"], "rvs"))
+    sampled[:, 8] = int(is_mcs_fixed)
+
+    assert 0. not in sampled[:, :-1], "Setting any value to 0 will cause buffer overflows and corrupted runs!"
+
+    return sampled
+
+
+def _simulation_worker(params, sims_per_sweep, imsize, output_categories_list, ring, stop_event,
+                       threads_per_worker, seed):
+    """Simulate, categorise and resize rabanis into the ring until told to stop"""
+    if threads_per_worker:
+        import numba
+        numba.set_num_threads(min(threads_per_worker, numba.config.NUMBA_NUM_THREADS))
+
+    rng = np.random.default_rng(seed)
+    while not stop_event.is_set():
+        sweep_params = sample_parameters(params, sims_per_sweep, rng)
+        imgs, _ = _run_rabani_sweep(sweep_params)
+
+        imgs = imgs.astype(np.int8)
+        _, cats = calculate_stats_batch(imgs, sweep_params[0, 6])
+        for img, cat in zip(imgs, cats):
+            if cat not in output_categories_list:
+                continue
+
+            resized_img = resize_image(img, imsize)
+            while not ring.put(resized_img, output_categories_list.index(cat), timeout=1):
+                if stop_event.is_set():
+                    return
@@ -0,0 +1,183 @@
+import os
+
+import h5py
+import numpy as np
+import tensorflow as tf
+from sklearn.utils import class_weight
+
+from Models.h5_iterator import load_category_index
+from Models.utils import resize_image
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def list_h5_files(simulated_image_dir):
+    """
+    List the simulation files in a directory (os.scandir rather than os.listdir for speed on massive datasets).
+    Sorted, as scandir order differs between filesystems
+    """
+    return sorted(file_entry.path for file_entry in os.scandir(simulated_image_dir)
+                  if file_entry.name.endswith(".h5"))
+
+
+def compute_class_weights(file_paths, output_categories_list):
+    """Compute balanced class weights of simulation files (all in one directory) from its cached category index"""
+    categories = load_category_index(os.path.dirname(file_paths[0]), file_paths)
+    class_inds = np.array([output_categories_list.index(category) for category in categories])
+
+    return class_weight.compute_class_weight('balanced', np.arange(len(output_categories_list)), class_inds)
+
+
+def make_rabani_dataset(simulated_image_dir, network_type, batch_size, output_categories_list, is_train, imsize,
+                        horizontal_flip=True, vertical_flip=True, x_noise=0.005, circshift=True,
+                        randomise_levels=False, force_binarisation=True, output_dtype=tf.float32, cycle_length=None,
+                        seed=None, rank=0, world_size=1):
+    """
+    A tf.data equivalent of Models.h5_iterator.h5RabaniDataGenerator
+
+    Files are read in parallel through an interleave, and augmentation/binarisation run as graph ops under
+    map(num_parallel_calls=AUTOTUNE), so none of the input pipeline is held up by the GIL
+
+    Parameters
+    ----------
+    simulated_image_dir : str
+        The image directory to run through. Must only have h5 files in it
+    network_type : str
+        The calling network type. Must be one of ["classifier", "autoencoder"]
+    batch_size : int
+        Number of items in each batch
+    output_categories_list : iterable of str
+        Categories to be predicted by the network if network_type == "classifier"
+    is_train : bool
+        If True, the dataset is shuffled, repeated indefinitely and augmented
+    imsize : int
+        Size to enlarge each simulation to
+    horizontal_flip : bool, optional
+        Randomly applies horizontal flips. Only occurs if is_train is True
+    vertical_flip : bool, optional
+        Randomly applies vertical flips. Only occurs if is_train is True
+    x_noise : float or None, optional
+        Applies a percentage of speckle noise if not None. Only occurs if is_train is True
+    circshift : bool, optional
+        Randomly pans around the wrapped simulations. Only occurs if is_train is True
+    randomise_levels : bool, optional
+        Randomly swaps the integer denoting substrate/liquid/nanoparticle. Only occurs if is_train is True
+    force_binarisation : bool, optional
+        If we should force the image to be binarised or not
+    output_dtype : tf.DType, optional
+        Dtype of the images handed to the model. Default tf.float32
+    cycle_length : int or None, optional
+        Number of files read concurrently. Default None (AUTOTUNE)
+    seed : int or None, optional
+        Seed for the shuffle order. Default None
+    rank : int, optional
+        Index of this process amongst those splitting the dataset. Default 0
+    world_size : int, optional
+        Number of processes splitting the dataset. Each gets a disjoint shard. Default 1
+
+    Returns
+    -------
+    dataset : tf.data.Dataset
+        Batches of (x, one-hot y) for a classifier, or (noisy x, x) for an autoencoder
+
+    See Also
+    --------
+    Models.h5_iterator.h5RabaniDataGenerator
+    """
+    assert network_type in ['classifier', 'autoencoder']
+    output_categories_list = list(output_categories_list)
+    file_paths = list_h5_files(simulated_image_dir)
+
+    def load_h5(file_path):
+        with h5py.File(file_path.decode(), "r") as h5_file:
+            img = resize_image(h5_file["sim_results"]["image"][()], imsize).astype(np.int32)
+            category_ind = np.int32(output_categories_list.index(h5_file.attrs["category"]))
+
+        return img, category_ind
+
+    def read_file(file_path):
+        img, category_ind = tf.numpy_function(load_h5, [file_path], [tf.int32, tf.int32])
+        img = tf.reshape(img, (imsize, imsize, 1))
+        category_ind = tf.reshape(category_ind, ())
+
+        return tf.data.Dataset.from_tensors((img, category_ind))
+
+    def augment(img, category_ind):
+        if vertical_flip:
+            img = tf.image.random_flip_up_down(img)
+        if horizontal_flip:
+            img = tf.image.random_flip_left_right(img)
+        if circshift:
+            img = tf.roll(img, shift=tf.random.uniform((2,), 0, imsize, dtype=tf.int32), axis=[0, 1])
+        if randomise_levels:
+            img = tf.gather(tf.random.shuffle(tf.range(3)), img)
+        if x_noise:
+            img = speckle_noise(img, x_noise, perc_std=0.002)
+
+        return img, category_ind
+
+    def binarise(img, category_ind):
+        if force_binarisation:
+            img = binarise_image(img)
+
+        return tf.cast(img, output_dtype), category_ind
+
+    def to_model_inputs(batch_x, batch_category_inds):
+        if network_type == "classifier":
+            return batch_x, tf.one_hot(batch_category_inds, len(output_categories_list), dtype=output_dtype)
+        else:
+            return speckle_noise(batch_x, perc_noise=0.4, perc_std=0.005), batch_x
+
+    dataset = tf.data.Dataset.from_tensor_slices(file_paths).shard(world_size, rank)
+    if is_train:
+        dataset = dataset.shuffle(len(file_paths), seed=seed, reshuffle_each_iteration=True).repeat()
+
+    dataset = dataset.interleave(read_file, cycle_length=cycle_length or AUTOTUNE, num_parallel_calls=AUTOTUNE)
+    if is_train:
+        dataset = dataset.map(augment, num_parallel_calls=AUTOTUNE)
+    dataset = dataset.map(binarise, num_parallel_calls=AUTOTUNE)
+    dataset = dataset.batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(to_model_inputs, num_parallel_calls=AUTOTUNE)
+
+    options = tf.data.Options()
+    options.deterministic = not is_train
+    dataset = dataset.with_options(options)
+
+    return dataset.prefetch(AUTOTUNE)
+
+
+def speckle_noise(img, perc_noise, perc_std, scaling=True):
+    """Graph equivalent of h5RabaniDataGenerator.speckle_noise with randomness="elementwise", for one image/batch"""
+    # One noise level per image, as in h5RabaniDataGenerator
+    p_shape = (tf.shape(img)[0], 1, 1, 1) if img.shape.rank == 4 else ()
+    p = tf.abs(tf.random.normal(p_shape, mean=perc_noise, stddev=perc_std))
+    rand_mask = tf.random.uniform(tf.shape(img)) < p
+
+    num_uniques = tf.size(tf.unique(tf.reshape(img, (-1,))).y)
+    rand_arr = tf.random.uniform(tf.shape(img), 0, tf.maximum(num_uniques - 1, 1), dtype=tf.int32)
+    if scaling:
+        rand_arr *= (num_uniques - 1)
+
+    # Ignore if array is single-valued
+    rand_mask = tf.logical_and(rand_mask, num_uniques > 1)
+
+    return tf.where(rand_mask, tf.cast(rand_arr, img.dtype), img)
+
+
+def binarise_image(img):
+    """Graph equivalent of Models.utils.binarise_batch for a single image of integer levels 0, 1 and 2"""
+    num_pix = tf.cast(tf.size(img), tf.float32)
+    counts = tf.math.bincount(tf.reshape(img, (-1,)), minlength=3, maxlength=3)
+    fractions = tf.cast(counts, tf.float32) / num_pix
+
+    is_ternary = tf.reduce_all(counts > 0)
+    is_hole = tf.logical_and(fractions[1] >= 0.4, fractions[0] >= 0.02)  # Hole, so don't remove substrate
+    least_common = tf.where(is_hole, 2, tf.cast(tf.argmin(counts), tf.int32))
+
+    remaining_levels = tf.gather(tf.constant([[1, 2], [0, 2], [0, 1]]), least_common)
+    replacement_vals = tf.gather(remaining_levels, tf.random.uniform(tf.shape(img), 0, 2, dtype=tf.int32))
+    img = tf.where(tf.logical_and(is_ternary, tf.equal(img, least_common)), replacement_vals, img)
+
+    # Single-valued images are left as zeros rather than divided by zero
+    img = img - tf.reduce_min(img)
+    return tf.cast(img, tf.float32) / tf.cast(tf.maximum(tf.reduce_max(img), 1), tf.float32)
@@ -1,23 +1,46 @@
 import datetime
 import os
 
+import numpy as np
 from tensorflow.keras.optimizers import Adam
 from tensorflow.python.keras.callbacks import ModelCheckpoint
 from tensorflow.python.keras.models import load_model
 
-from Analysis.model_stats import plot_model_history, test_classifier
+from Analysis.model_stats import plot_model_history, test_classifier_streaming, StreamingClassifierStats, \
+    StreamingReconstructionStats
+from Models.callbacks import ThroughputLogger
 from Models.h5_iterator import h5RabaniDataGenerator
 from Models.model_CNN import get_model, autoencoder
+from Models.prefetch import SharedMemoryPrefetcher
+from Models.tf_dataset import make_rabani_dataset, list_h5_files, compute_class_weights
 
 
-def train_CNN(model_dir, train_datadir, test_datadir, y_params, y_cats, batch_size, epochs, imsize, network_type):
+def train_CNN(model_dir, train_datadir, test_datadir, y_params, y_cats, batch_size, epochs, imsize, network_type,
+              data_backend="sequence", prefetch_workers=0, sampler="sequential"):
+    """
+    Train a CNN, feeding it either through h5RabaniDataGenerator ("sequence") or a tf.data pipeline ("tf.data").
+    If prefetch_workers, training batches from the sequence are made in background processes. sampler is passed to
+    the training h5RabaniDataGenerator. Throughput of each batch is logged to throughput.jsonl next to the checkpoint
+    """
+    if data_backend not in ["sequence", "tf.data"]:
+        raise ValueError("data_backend must be one of ['sequence', 'tf.data']")
+
     # Set up generators
-    train_generator = h5RabaniDataGenerator(train_datadir, network_type=network_type, batch_size=batch_size,
-                                            is_train=True, imsize=imsize,
-                                            output_parameters_list=y_params, output_categories_list=y_cats)
-    test_generator = h5RabaniDataGenerator(test_datadir, network_type=network_type, batch_size=batch_size,
-                                           is_train=False, imsize=imsize,
-                                           output_parameters_list=y_params, output_categories_list=y_cats)
+    if data_backend == "sequence":
+        train_generator = h5RabaniDataGenerator(train_datadir, network_type=network_type, batch_size=batch_size,
+                                                is_train=True, imsize=imsize, sampler=sampler,
+                                                output_parameters_list=y_params, output_categories_list=y_cats)
+        test_generator = h5RabaniDataGenerator(test_datadir, network_type=network_type, batch_size=batch_size,
+                                               is_train=False, imsize=imsize,
+                                               output_parameters_list=y_params, output_categories_list=y_cats)
+        if prefetch_workers:
+            train_generator = SharedMemoryPrefetcher(train_generator, num_workers=prefetch_workers)
+    else:
+        train_files = list_h5_files(train_datadir)
+        train_dataset = make_rabani_dataset(train_datadir, network_type=network_type, batch_size=batch_size,
+                                            output_categories_list=y_cats, is_train=True, imsize=imsize)
+        test_dataset = make_rabani_dataset(test_datadir, network_type=network_type, batch_size=batch_size,
+                                           output_categories_list=y_cats, is_train=False, imsize=imsize)
 
     # Set up model
     if network_type == "classifier":
@@ -29,23 +52,54 @@ def train_CNN(model_dir, train_datadir, test_datadir, y_params, y_cats, batch_si
     model = load_model("/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks/2020-05-29--10-48/model.h5")
 
     # early_stopping = EarlyStopping(monitor="val_loss", patience=10)
-    model_checkpoint = ModelCheckpoint(get_model_storage_path(model_dir), monitor="val_loss", save_best_only=True)
+    model_path = get_model_storage_path(model_dir)
+    model_checkpoint = ModelCheckpoint(model_path, monitor="val_loss", save_best_only=True)
 
     # Train
-    model.fit_generator(generator=train_generator,
-                        validation_data=test_generator,
-                        steps_per_epoch=train_generator.__len__() // 10,
-                        validation_steps=test_generator.__len__(),
-                        class_weight=train_generator.class_weights_dict,
-                        epochs=epochs,
-                        max_queue_size=100)
+    if data_backend == "sequence":
+        throughput_logger = ThroughputLogger(os.path.join(os.path.dirname(model_path), "throughput.jsonl"),
+                                             generator=train_generator, batch_size=batch_size)
+        # A SharedMemoryPrefetcher makes batches ahead in its own processes, and refills each batch's memory once the
+        # next is asked for, so keras mustn't read ahead of the model too
+        model.fit_generator(generator=train_generator,
+                            validation_data=test_generator,
+                            steps_per_epoch=train_generator.__len__() // 10,
+                            validation_steps=test_generator.__len__(),
+                            class_weight=train_generator.class_weights_dict,
+                            epochs=epochs,
+                            max_queue_size=100,
+                            workers=0 if prefetch_workers else 1,
+                            callbacks=[throughput_logger])
+
+        if prefetch_workers:
+            train_generator.stop()
+    else:
+        if network_type == "classifier":
+            class_weights = dict(enumerate(compute_class_weights(train_files, y_cats)))
+        else:
+            class_weights = None
+
+        throughput_logger = ThroughputLogger(os.path.join(os.path.dirname(model_path), "throughput.jsonl"),
+                                             batch_size=batch_size)
+        model.fit(x=train_dataset,
+                  validation_data=test_dataset,
+                  steps_per_epoch=(len(train_files) // batch_size) // 10,
+                  validation_steps=len(list_h5_files(test_datadir)) // batch_size,
+                  class_weight=class_weights,
+                  epochs=epochs,
+                  callbacks=[throughput_logger])
 
     return model
 
 
 def validate_CNN(model, validation_datadir, network_type, y_params, y_cats, batch_size, imsize=128,
-                 steps=None):
+                 steps=None, data_backend="sequence"):
     """Prediction generator for simulated validation data"""
+    if data_backend == "tf.data":
+        return _validate_CNN_tf_data(model, validation_datadir, network_type, y_cats, batch_size, imsize, steps)
+    elif data_backend != "sequence":
+        raise ValueError("data_backend must be one of ['sequence', 'tf.data']")
+
     validation_generator = h5RabaniDataGenerator(validation_datadir, network_type=network_type, batch_size=batch_size,
                                                  is_train=False, imsize=imsize, output_parameters_list=y_params,
                                                  output_categories_list=y_cats, force_binarisation=True)
@@ -66,6 +120,73 @@ def validate_CNN(model, validation_datadir, network_type, y_params, y_cats, batc
     return validation_preds, validation_truth
 
 
+def _validate_CNN_tf_data(model, validation_datadir, network_type, y_cats, batch_size, imsize, steps):
+    """validate_CNN through the tf.data pipeline, with the truth taken from each batch as it is predicted"""
+    if network_type not in ["classifier", "autoencoder"]:
+        raise ValueError("Network type must be 'classifier' or 'autoencoder")
+
+    if not steps:
+        steps = len(list_h5_files(validation_datadir)) // batch_size
+
+    validation_dataset = make_rabani_dataset(validation_datadir, network_type=network_type, batch_size=batch_size,
+                                             output_categories_list=y_cats, is_train=False, imsize=imsize,
+                                             force_binarisation=True)
+
+    validation_preds = []
+    validation_truth = []
+    for batch_x, batch_y in validation_dataset.take(steps):
+        validation_preds.append(model.predict_on_batch(batch_x))
+        validation_truth.append(batch_y.numpy())
+
+    return np.concatenate(validation_preds), np.concatenate(validation_truth)
+
+
+def validate_CNN_streaming(model, validation_datadir, network_type, y_params, y_cats, batch_size, imsize=128,
+                           steps=None, data_backend="sequence"):
+    """
+    Validate on simulated data batch by batch, so only one batch of images and predictions is held at a time
+
+    Returns
+    -------
+    stats : StreamingClassifierStats or StreamingReconstructionStats
+        Accumulated performance, depending on network_type
+
+    See Also
+    --------
+    Analysis.model_stats.test_classifier_streaming
+    """
+    if network_type == "classifier":
+        stats = StreamingClassifierStats(y_cats)
+    elif network_type == "autoencoder":
+        stats = StreamingReconstructionStats()
+    else:
+        raise ValueError("Network type must be 'classifier' or 'autoencoder")
+
+    if data_backend == "sequence":
+        # is_validation_set stays False, so the generator doesn't keep its own copy of the truth
+        validation_generator = h5RabaniDataGenerator(validation_datadir, network_type=network_type,
+                                                     batch_size=batch_size, is_train=False, imsize=imsize,
+                                                     output_parameters_list=y_params, output_categories_list=y_cats,
+                                                     force_binarisation=True)
+        if not steps:
+            steps = validation_generator.__len__()
+        batches = (validation_generator[i] for i in range(steps))
+    elif data_backend == "tf.data":
+        if not steps:
+            steps = len(list_h5_files(validation_datadir)) // batch_size
+        validation_dataset = make_rabani_dataset(validation_datadir, network_type=network_type,
+                                                 batch_size=batch_size, output_categories_list=y_cats,
+                                                 is_train=False, imsize=imsize, force_binarisation=True)
+        batches = ((batch_x, batch_y.numpy()) for batch_x, batch_y in validation_dataset.take(steps))
+    else:
+        raise ValueError("data_backend must be one of ['sequence', 'tf.data']")
+
+    for batch_x, batch_y in batches:
+        stats.update(batch_y, model.predict_on_batch(batch_x))
+
+    return stats
+
+
 def get_model_storage_path(root_dir):
     current_datetime = datetime.datetime.now().strftime("%Y-%m-%d--%H-%M")
     os.mkdir(f"{root_dir}/{current_datetime}")
@@ -106,6 +227,6 @@ if __name__ == '__main__':
 
     save_model(trained_model, "/home/mltest1/tmp/pycharm_project_883/Data/Trained_Networks")
 
-    preds, truth = validate_CNN(trained_model, testing_data_dir, "classifier",
-                                original_parameters, original_categories, 128, 200)
-    performance = test_classifier(trained_model, x_test=None, y_true=truth, y_pred=preds, cats=original_categories)
+    validation_stats = validate_CNN_streaming(trained_model, testing_data_dir, "classifier",
+                                              original_parameters, original_categories, 128, 200)
+    performance = test_classifier_streaming(validation_stats)
@@ -6,7 +6,7 @@ from skimage.morphology import closing, square
 from sklearn.linear_model import LogisticRegression
 from tqdm import tqdm
 
-from Analysis.image_stats import calculate_normalised_stats
+from Analysis.image_stats import calculate_normalised_stats_batch
 from Analysis.model_stats import test_classifier
 from Analysis.plot_rabani import cmap_rabani
 # from Analysis.tests import plot_regression_3d
@@ -45,18 +45,17 @@ def make_dataset(rabani_dir, output_dir=None, batch_size=128, max_ims=5000, save
 
     # For each batch of images
     for i in tqdm(range(min([img_generator.__len__(), max_ims//batch_size]))):
-        x, y = img_generator.__getitem__(None)
+        x, y = img_generator.__getitem__(i)
 
-        # For each image, calculate and store stats
+        # Calculate stats for the whole batch at once, then store each image's
+        SIAs, SIPs, SIEs = calculate_normalised_stats_batch(x[:, :, :, 0])
         for j in range(batch_size):
-            SIA, SIP, SIE = calculate_normalised_stats(x[j, :, :, 0])
-
             # Place in dframe
             num_img = (i * batch_size) + j
             dframe.loc[num_img, "label"] = y_cats[y[j].argmax()]
-            dframe.loc[num_img, "SIA"] = SIA
-            dframe.loc[num_img, "SIP"] = SIP
-            dframe.loc[num_img, "SIE"] = SIE
+            dframe.loc[num_img, "SIA"] = SIAs[j]
+            dframe.loc[num_img, "SIP"] = SIPs[j]
+            dframe.loc[num_img, "SIE"] = SIEs[j]
 
             if save_ims:
                 img = closing(x[j, :, :, 0], square(3))
@@ -1,3 +1,4 @@
+import functools
 import glob
 import itertools
 import os
@@ -5,6 +6,7 @@ import os
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
+from skimage import img_as_float
 from skimage.transform import resize
 from tqdm import tqdm
 
@@ -69,23 +71,162 @@ def resize_image(image, newsize):
     """Enlarge image"""
     assert image.shape[0] <= newsize, f"New size ({newsize}) must be larger than original size ({image.shape[0]})"
     if image.shape[0] != newsize:
-        num_tiles = newsize / image.shape[0]
-        if num_tiles % 1 == 0:
-            # Resize 2^n
-            new_image = np.repeat(np.repeat(image, int(num_tiles), axis=0), int(num_tiles), axis=1)
-        else:
-            # Resize by nn-interpolation
-            new_image = (resize(image, (newsize, newsize), order=0) * 255 // 2).astype(int)
-
-            # Fix aliasing making NP -> L
-            if np.all(np.unique(image) == [0, 2]):
-                new_image[new_image == 1] = 2
+        new_image = _resize_stack(image[np.newaxis, :, :], newsize)[0]
     else:
         new_image = image
 
     return new_image
 
 
+def resize_images(images, newsize):
+    """
+    Enlarge a list of square images of (possibly) differing sizes, with one gather per distinct input size
+
+    Parameters
+    ----------
+    images : iterable of ndarray
+        Square 2D images, each no larger than newsize
+    newsize : int
+        Size to enlarge each image to
+
+    Returns
+    -------
+    new_images : ndarray
+        (N x newsize x newsize) array of images with the same levels resize_image would give
+
+    See Also
+    --------
+    Models.utils.resize_image
+    """
+    sizes = np.array([len(image) for image in images])
+    assert np.all(sizes <= newsize), f"New size ({newsize}) must be larger than original sizes ({sizes.max()})"
+
+    new_images = np.empty((len(images), newsize, newsize), dtype=int)
+    for size in np.unique(sizes):
+        inds = np.nonzero(sizes == size)[0]
+        stack = np.stack([images[i] for i in inds])
+        new_images[inds] = stack if size == newsize else _resize_stack(stack, newsize)
+
+    return new_images
+
+
+@functools.lru_cache(maxsize=None)
+def _nearest_resize_map(src_size, dst_size):
+    """
+    Index of the source row/column that skimage's nearest neighbour resize picks for each destination row/column.
+    Taken from resize itself (on an image of its own indices), so the gather is identical to resize(order=0)
+    """
+    src_inds = np.tile(np.arange(src_size, dtype=np.float64)[:, np.newaxis], (1, src_size))
+    resize_map = resize(src_inds, (dst_size, dst_size), order=0, preserve_range=True)[:, 0].astype(np.intp)
+    resize_map.setflags(write=False)
+
+    return resize_map
+
+
+def _resize_stack(stack, newsize):
+    """Enlarge a (N x L x L) stack of images to (N x newsize x newsize) with a single fancy-index"""
+    num_tiles = newsize / stack.shape[1]
+    if num_tiles % 1 == 0:
+        # Resize 2^n
+        resize_map = np.arange(newsize) // int(num_tiles)
+        return stack[:, resize_map[:, np.newaxis], resize_map[np.newaxis, :]]
+
+    # Resize by nn-interpolation. resize converts to float with img_as_float before interpolating, so the
+    # same conversion is applied to the (smaller) source images before the gather
+    resize_map = _nearest_resize_map(stack.shape[1], newsize)
+    levels = (img_as_float(stack) * 255 // 2).astype(int)
+    new_stack = levels[:, resize_map[:, np.newaxis], resize_map[np.newaxis, :]]
+
+    # Fix aliasing making NP -> L
+    is_np_substrate = np.all((stack == 0) | (stack == 2), axis=(1, 2)) & np.any(stack == 0, axis=(1, 2)) & \
+                      np.any(stack == 2, axis=(1, 2))
+    new_stack[is_np_substrate] = np.where(new_stack[is_np_substrate] == 1, 2, new_stack[is_np_substrate])
+
+    return new_stack
+
+
+class OverlapAddAccumulator:
+    """
+    Votes overlapping windows into a full-size image as they arrive, keeping only a running (weighted) sum and count
+    rather than every window at full size
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the full-size image
+    """
+
+    def __init__(self, shape):
+        self.weighted_sum = np.zeros(shape)
+        self.weight_total = np.zeros(shape)
+
+    def add(self, corner, window, weights=None):
+        """Add a window with its top-left corner at corner, optionally weighting each pixel"""
+        if weights is None:
+            weights = np.ones(window.shape)
+
+        region = (slice(corner[0], corner[0] + window.shape[0]), slice(corner[1], corner[1] + window.shape[1]))
+        self.weighted_sum[region] += weights * window
+        self.weight_total[region] += weights
+
+    def add_batch(self, corners, windows, weights=None):
+        """Add a batch of (N x H x W) windows, one corner each"""
+        for corner, window in zip(corners, windows):
+            self.add(corner, window, weights)
+
+    def result(self, empty_value=np.nan):
+        """Weighted mean of every window covering each pixel, or empty_value where none did"""
+        is_covered = self.weight_total > 0
+        voted = np.full(self.weighted_sum.shape, empty_value, dtype=float)
+        voted[is_covered] = self.weighted_sum[is_covered] / self.weight_total[is_covered]
+
+        return voted
+
+
+class SpeckleNoise:
+    """
+    Test-time speckle noise, applied in place to one batch after another, as
+    h5RabaniDataGenerator.speckle_noise(randomness="batchwise") but without full-size temporaries for every batch.
+    The random draws (float32) and noise mask are held in buffers reused across batches, and only the replacement
+    values of the noisy pixels (uint8) are allocated
+
+    Parameters
+    ----------
+    perc_noise : float
+        Fraction of pixels to replace
+    scaling : bool, optional
+        Scale replacement values by (num_uniques - 1), as speckle_noise. Default True
+    seed : int or numpy.random.Generator or None, optional
+        Seed (or generator) for the noise. Default None
+    """
+
+    def __init__(self, perc_noise, scaling=True, seed=None):
+        self.perc_noise = perc_noise
+        self.scaling = scaling
+        self.rng = np.random.default_rng(seed)
+        self._rand_buffer = np.empty(0, dtype=np.float32)
+        self._mask_buffer = np.empty(0, dtype=bool)
+
+    def __call__(self, batch_x, num_uniques):
+        """Add noise to batch_x in place (and return it), replacing pixels by one of num_uniques levels"""
+        if self._rand_buffer.size < batch_x.size:
+            self._rand_buffer = np.empty(batch_x.size, dtype=np.float32)
+            self._mask_buffer = np.empty(batch_x.size, dtype=bool)
+        rand_arr = self._rand_buffer[:batch_x.size].reshape(batch_x.shape)
+        rand_mask = self._mask_buffer[:batch_x.size].reshape(batch_x.shape)
+
+        self.rng.random(dtype=np.float32, out=rand_arr)
+        np.less_equal(rand_arr, self.perc_noise, out=rand_mask)
+
+        if num_uniques > 1:  # Ignore if array is single-valued
+            noise_vals = self.rng.integers(0, num_uniques - 1, size=np.count_nonzero(rand_mask), dtype=np.uint8)
+            if self.scaling:
+                noise_vals *= (num_uniques - 1)
+            batch_x[rand_mask] = noise_vals
+
+        return batch_x
+
+
 def remove_least_common_level(image):
     level_vals, counts = np.unique(image, return_counts=True)
 
@@ -114,6 +255,66 @@ def normalise(image):
     return image
 
 
+def binarise_batch(batch_x, num_levels=3, rngs=None):
+    """
+    Batched equivalent of remove_least_common_level followed by normalise
+
+    Level counts for the whole batch come from a single bincount. The least common level of each image is then
+    swapped for one of the remaining two, and each image normalised, in a single gather through a per-image
+    lookup table
+
+    Parameters
+    ----------
+    batch_x : ndarray
+        (N x H x W x 1) or (N x H x W) array of integer-valued levels in [0, num_levels). Overwritten in place
+    num_levels : int, optional
+        Number of levels in the simulations. Default 3 (substrate, liquid, nanoparticle)
+    rngs : list of numpy.random.Generator or None, optional
+        One generator per image for the replacement levels. Default None (the global numpy RNG)
+    """
+    num_imgs = len(batch_x)
+    levels = batch_x.reshape(num_imgs, -1).astype(np.intp)
+    num_pix = levels.shape[1]
+
+    offsets = np.arange(num_imgs)[:, np.newaxis] * num_levels
+    counts = np.bincount((levels + offsets).ravel(),
+                         minlength=num_imgs * num_levels).reshape(num_imgs, num_levels)
+
+    # Only images containing all three levels get patched
+    is_ternary = np.all(counts > 0, axis=1)
+    is_hole = (counts[:, 1] / num_pix >= 0.4) & (counts[:, 0] / num_pix >= 0.02)  # Hole, so don't remove substrate
+    least_common = np.where(is_hole, 2, np.argmin(counts, axis=1))
+
+    replace_mask = (levels == least_common[:, np.newaxis]) & is_ternary[:, np.newaxis]
+    replace_rows = np.nonzero(replace_mask)[0]
+    remaining_levels = np.array([[1, 2], [0, 2], [0, 1]])[least_common]
+    if rngs is None:
+        coins = np.random.randint(0, 2, size=len(replace_rows))
+    else:
+        # replace_rows is sorted, so each image's coins are contiguous
+        coins = np.concatenate([rng.integers(0, 2, size=n)
+                                for rng, n in zip(rngs, np.bincount(replace_rows, minlength=num_imgs))])
+    replacement_vals = remaining_levels[replace_rows, coins]
+    levels[replace_mask] = replacement_vals
+
+    # Min/max of each patched image are found from the updated level counts, not another pass over the pixels
+    counts[is_ternary, least_common[is_ternary]] = 0
+    counts += np.bincount(replace_rows * num_levels + replacement_vals,
+                          minlength=num_imgs * num_levels).reshape(num_imgs, num_levels)
+    present = counts > 0
+    min_level = np.argmax(present, axis=1)
+    max_level = num_levels - 1 - np.argmax(present[:, ::-1], axis=1)
+
+    # Single-valued images are left as zeros rather than divided by zero, so integer buffers stay valid
+    level_range = np.maximum(max_level - min_level, 1)
+    lut = (np.arange(num_levels) - min_level[:, np.newaxis]) / level_range[:, np.newaxis]
+    lut[max_level == min_level] = 0
+
+    batch_x[:] = lut.ravel()[levels + offsets].reshape(batch_x.shape)
+
+    return batch_x
+
+
 def ind_to_onehot(y_preds):
     if np.array(y_preds).ndim != 2:
         return np.eye(np.max(y_preds) + 1)[np.array(y_preds)]
@@ -10,7 +10,7 @@ import numpy as np
 import paramiko
 from tqdm import tqdm
 
-from Analysis.image_stats import calculate_stats
+from Analysis.image_stats import calculate_stats_batch
 from Rabani_Simulation.rabani import _run_rabani_sweep
 
 
@@ -144,12 +144,21 @@ class RabaniSweeper:
             os.makedirs(dir)
 
     def save_rabanis(self, imgs, m_all, params):
+        """
+        Save each simulation to its own h5 file. Files are written under a temporary name and renamed once
+        complete, so anything listing the directory (e.g. a generator training on it) only ever sees finished files
+        """
+        regions, cats = calculate_stats_batch(imgs, params[:, 6])
         for rep, img in enumerate(imgs):
-            master_file = h5py.File(
-                f"{self._file_base}--{self.sweep_cnt}.h5",
-                "a")
+            region = {key: value[rep] for key, value in regions.items()}
+            cat = str(cats[rep])
+
+            file_path = f"{self._file_base}--{self.sweep_cnt}.h5"
+            if (cat == "none") and (self.generate_mode == "make_dataset"):
+                self.sweep_cnt += 1
+                continue
 
-            region, cat = calculate_stats(img, params[rep, 6])
+            master_file = h5py.File(f"{file_path}.tmp", "w")
 
             master_file.attrs["kT"] = params[rep, 0]
             master_file.attrs["mu"] = params[rep, 1]
@@ -173,9 +182,7 @@ class RabaniSweeper:
             region_props.create_dataset("eccentricity", data=region["eccentricity"], dtype="f")
 
             master_file.close()
-
-            if (cat == "none") and (self.generate_mode == "make_dataset"):
-                os.remove(f"{self._file_base}--{self.sweep_cnt}.h5")
+            os.replace(f"{file_path}.tmp", file_path)
 
             if self.sftp_when_done:
                 self.network_rabanis()